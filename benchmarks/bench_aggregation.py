@@ -0,0 +1,53 @@
+"""Tree reduction of the flood decision versus reducing the computed cube."""
+
+import dask
+import xarray as xr
+from common import make_flood_dc, measure, report
+
+from dask_flood_mapper.calculation import (
+    bayesian_flood_decision,
+    calc_water_likelihood,
+    harmonic_expected_backscatter,
+    temporal_aggregates,
+)
+
+
+def make_decision(n_time=32, size=512):
+    dc = make_flood_dc(n_time=n_time, size=size)
+    dc["wbsc"] = calc_water_likelihood(dc)
+    dc["hbsc"] = harmonic_expected_backscatter(dc)
+    return bayesian_flood_decision(dc).where(dc.sig0.notnull())
+
+
+def reduce_cube(decision):
+    flooded = decision == 1
+    return xr.Dataset(
+        {
+            "extent": decision.max("time"),
+            "frequency": decision.sum("time", min_count=1),
+            "first_detection": decision.time[flooded.argmax("time")].where(
+                flooded.any("time")
+            ),
+        }
+    )
+
+
+def reduce_computed_cube(decision):
+    """Previous workflow, compute ``flood.decision`` and reduce it afterwards."""
+    return dask.delayed(reduce_cube)(decision)
+
+
+def tree_reduction(decision):
+    return xr.Dataset(temporal_aggregates(decision))
+
+
+def main():
+    rows = []
+    for func in (reduce_computed_cube, tree_reduction):
+        runtime, peak = measure(func(make_decision()))
+        rows.append((func.__name__, (f"{peak:.1f}", f"{runtime:.3f}")))
+    report(("peak MiB", "compute s"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Fused classification kernel versus the separate xarray steps."""
+
+from common import make_flood_dc, measure, n_tasks, report
+
+from dask_flood_mapper.calculation import (
+    bayesian_flood_decision,
+    bayesian_flood_probability,
+    calc_water_likelihood,
+    classify_flood_dc,
+    harmonic_expected_backscatter,
+)
+from dask_flood_mapper.processing import post_processing
+
+
+def separate_steps(dc):
+    dc = dc.copy()
+    dc["wbsc"] = calc_water_likelihood(dc)
+    dc["hbsc"] = harmonic_expected_backscatter(dc)
+    dc["decision"] = bayesian_flood_decision(dc)
+    dc["f_post_prob"] = bayesian_flood_probability(dc)
+    dc["nf_post_prob"] = 1 - dc["f_post_prob"]
+    return post_processing(dc)
+
+
+def fused(dc):
+    flood_dc = classify_flood_dc(dc)
+    return flood_dc.decision * flood_dc.mask
+
+
+def main():
+    graph = make_flood_dc(n_time=8)
+    chunk = make_flood_dc(n_time=1).persist()
+    rows = []
+    for func in (separate_steps, fused):
+        runtime, peak = measure(func(chunk))
+        rows.append(
+            (
+                func.__name__,
+                (n_tasks(func(graph)), f"{peak:.1f}", f"{runtime:.3f}"),
+            )
+        )
+    report(("tasks", "peak MiB", "chunk s"), rows)
+
+
+if __name__ == "__main__":
+    main()
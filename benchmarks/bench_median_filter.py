@@ -0,0 +1,31 @@
+"""Chunked median filter versus xarray's rolling median for speckle removal."""
+
+from common import make_flood_dc, measure, report
+
+from dask_flood_mapper.calculation import median_filter
+
+
+def rolling(decision):
+    return decision.rolling({"x": 5, "y": 5}, center=True).median(skipna=True)
+
+
+def chunked(decision):
+    return median_filter(decision, 5)
+
+
+def majority_vote(decision):
+    return median_filter(decision, 5, binary=True)
+
+
+def main():
+    dc = make_flood_dc(n_time=1, size=1024, chunk=512).persist()
+    decision = (dc.sig0 > -15).where(dc.sig0.notnull())
+    rows = []
+    for func in (rolling, chunked, majority_vote):
+        runtime, peak = measure(func(decision))
+        rows.append((func.__name__, (f"{peak:.1f}", f"{runtime:.3f}")))
+    report(("peak MiB", "s"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Sort-based mosaicking versus groupby mean over duplicate time stamps."""
+
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from common import measure, n_tasks, report
+
+from dask_flood_mapper.processing import mosaic
+
+
+def make_acquisitions(n_time=160, n_unique=120, size=256, seed=0):
+    """Acquisitions on ``n_unique`` dates, some split over two tiles."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2020-01-01", periods=n_unique, freq="6D").values
+    time_ = np.sort(np.concatenate([dates, rng.choice(dates, n_time - n_unique)]))
+    values = rng.uniform(-25, -5, (n_time, size, size))
+    values[rng.uniform(size=values.shape) < 0.5] = np.nan
+    return xr.Dataset(
+        {"sig0": (("time", "y", "x"), values)},
+        coords={"time": time_, "y": np.arange(size), "x": np.arange(size)},
+    ).chunk({"time": 1})
+
+
+def groupby_mean(dc):
+    return dc.groupby("time").mean(skipna=True)
+
+
+def sort_mosaic(dc):
+    return mosaic(dc, "time")
+
+
+def main():
+    dc = make_acquisitions().persist()
+    rows = []
+    for func in (groupby_mean, sort_mosaic):
+        start = time.perf_counter()
+        result = func(dc)
+        build = time.perf_counter() - start
+        runtime, peak = measure(result)
+        rows.append(
+            (
+                func.__name__,
+                (n_tasks(result), f"{build:.3f}", f"{runtime:.3f}", f"{peak:.1f}"),
+            )
+        )
+    report(("tasks", "graph s", "compute s", "peak MiB"), rows)
+
+
+if __name__ == "__main__":
+    main()
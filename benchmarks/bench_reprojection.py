@@ -0,0 +1,47 @@
+"""Chunked reprojection with and without cached pixel indices versus rioxarray."""
+
+import dask
+import rioxarray  # noqa
+
+from common import make_flood_dc, measure, report
+
+from dask_flood_mapper.reprojection import index_cache, reproject_chunked
+
+BBOX = [12.65, 48.45, 12.9, 48.6]
+
+
+def make_decision():
+    dc = make_flood_dc(n_time=4, size=1536, chunk=512)
+    decision = (dc.sig0 > -15).where(dc.sig0.notnull())
+    decision = decision.assign_coords(
+        y=1_700_000 - 20 * decision.y - 10, x=5_000_000 + 20 * decision.x + 10
+    )
+    return decision.rio.write_crs("EPSG:27704").persist()
+
+
+@dask.delayed
+def rio_reproject(decision):
+    # rioxarray reprojects eagerly, so delay it to measure the computation
+    return decision.rio.reproject("EPSG:4326").rio.clip_box(*BBOX)
+
+
+def chunked_cold(decision):
+    index_cache().entries.clear()
+    return reproject_chunked(decision, BBOX)
+
+
+def chunked_warm(decision):
+    return reproject_chunked(decision, BBOX)
+
+
+def main():
+    decision = make_decision()
+    rows = []
+    for func in (rio_reproject, chunked_cold, chunked_warm):
+        runtime, peak = measure(func(decision))
+        rows.append((func.__name__, (f"{peak:.1f}", f"{runtime:.3f}")))
+    report(("peak MiB", "s"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Helpers shared by the benchmark scripts.
+
+The benchmarks run on synthetic datacubes so that they do not depend on the
+EODC STAC catalog. Run them from the repository root, e.g.:
+
+    python benchmarks/bench_classification.py
+"""
+
+import time
+import tracemalloc
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from dask_flood_mapper.processing import BANDS_HPAR
+
+
+def make_flood_dc(n_time=4, size=512, chunk=512, seed=0):
+    """Synthetic flood datacube with sig0, MPLIA and harmonic parameters."""
+    rng = np.random.default_rng(seed)
+    shape = (n_time, size, size)
+    time_ = pd.date_range("2022-10-11", periods=n_time, freq="6D")
+
+    def uniform(low, high):
+        return (("time", "y", "x"), rng.uniform(low, high, shape))
+
+    dc = xr.Dataset(
+        {
+            "sig0": uniform(-25, -5),
+            "MPLIA": uniform(20, 50),
+            **{band: uniform(-1, 1) for band in BANDS_HPAR},
+        },
+        coords={"time": time_, "y": np.arange(size), "x": np.arange(size)},
+    )
+    dc["STD"] = dc.STD * 1.25 + 1.75
+    dc["M0"] = dc.M0 * 3.5 - 11.5
+    dc["sig0"] = dc.sig0.where(rng.uniform(size=shape) > 0.1)
+    return dc.chunk({"time": 1, "y": chunk, "x": chunk})
+
+
+def n_tasks(obj):
+    """Number of tasks in the (unoptimized) graph of a dask collection."""
+    return len(obj.__dask_graph__())
+
+
+def measure(obj):
+    """Compute a collection with the synchronous scheduler.
+
+    Returns the runtime in seconds and the peak of newly allocated memory in
+    MiB, which for a single chunk approximates the per-chunk footprint.
+    """
+    with dask.config.set(scheduler="synchronous"):
+        tracemalloc.start()
+        start = time.perf_counter()
+        dask.compute(obj)
+        runtime = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return runtime, peak
+
+
+def report(columns, rows):
+    """Print one row per variant, aligned under the column names."""
+    print(f"{'':<16}" + "".join(f"{c:>14}" for c in columns))
+    for name, values in rows:
+        print(f"{name:<16}" + "".join(f"{v:>14}" for v in values))
@@ -1,37 +1,200 @@
+import math
+import warnings
+
 import xarray as xr
 import numpy as np
-from dask.distributed import wait
+import dask.array as da
+from functools import partial
+from numpy.lib.stride_tricks import sliding_window_view
+from dask_flood_mapper.catalog import config
+from dask_flood_mapper.materialize import materialize
+from dask_flood_mapper.skipping import count_skipped, is_missing
 
 
 def calculate_flood_dc(sig0_dc, plia_dc, hpar_dc):
-    """Merge four data cubes and apply processing steps to clean and filter the dataset.
-    wcover_dc is optional."""
+    """Merge the sigma naught and static data cubes.
+
+    The harmonic parameters and incidence angles only change per orbit, so they
+    stay indexed by orbit instead of being copied for every acquisition. The
+    orbit of each acquisition is kept as the ``orbit_sig0`` coordinate, see
+    ``select_orbits``. Time steps without sigma naught are already dropped by
+    ``processing.process_sig0_dc``, so nothing is computed here, whatever
+    the materialize strategy."""
 
+    sig0_dc = sig0_dc.rename({"orbit": "orbit_sig0"})
     flood_dc = xr.merge([sig0_dc, plia_dc, hpar_dc])
-    flood_dc = (
-        flood_dc.reset_index("orbit", drop=True)
-        .rename({"orbit": "time"})
-        .dropna(dim="time", how="all", subset=["sig0"])
-    )
 
-    flood_dc = flood_dc.persist()
-    wait(flood_dc)
+    return materialize(flood_dc, "flood_dc")
+
+
+def select_orbits(dc):
+    """Align the static layers indexed by orbit with the acquisitions in time.
+
+    The selection is lazy, every time chunk only references the block of its
+    orbit, so the layers are broadcast per chunk when they are used. Datasets
+    without an orbit dimension are returned unchanged.
+    """
+    if "orbit" not in dc.dims:
+        return dc
+    static_dc = dc[[var for var in dc.data_vars if "orbit" in dc[var].dims]]
+    static_dc = static_dc.sel(orbit=dc.orbit_sig0).drop_vars(["orbit", "orbit_sig0"])
+    return dc.drop_dims("orbit").drop_vars("orbit_sig0").merge(static_dc)
+
+
+def remove_speckles(flood_output, window_size=5, min_periods=None, binary=False):
+    """Apply a rolling median filter to smooth the dataset spatially over longitude and latitude.
+
+    See ``median_filter``; ``binary=True`` selects the majority vote for
+    decisions that only hold 0, 1 and NaN."""
+
+    flood_output = median_filter(flood_output, window_size, min_periods, binary)
 
-    return flood_dc
+    return materialize(flood_output, "speckles")
 
 
-def remove_speckles(flood_output, window_size=5):
-    """Apply a rolling median filter to smooth the dataset spatially over longitude and latitude."""
+def median_filter(dc, window_size=5, min_periods=None, binary=False):
+    """Spatial median filter over y and x, applied chunk-wise.
 
-    flood_output = (
-        flood_output.rolling({"x": window_size, "y": window_size}, center=True)
-        .median(skipna=True)
-        .persist()
+    Chunks exchange a halo of ``window_size // 2`` pixels with their neighbours
+    (``map_overlap``), so no windowed copy of the whole datacube is created.
+    Gives the same result as ``rolling(center=True).median(skipna=True)``:
+    windows with less than ``min_periods`` valid pixels, by default the full
+    window, become NaN and the remaining NaNs are skipped.
+
+    With ``binary=True`` the input may only hold 0, 1 and NaN, as the flood
+    decision does. The median is then a majority vote, which is computed from
+    window sums instead of sorting every window.
+
+    Integer data with a ``_FillValue`` attribute, such as uint8 decisions,
+    stays encoded: the fill value marks missing pixels and medians halfway
+    between two values are rounded up.
+    """
+    if isinstance(dc, xr.Dataset):
+        return dc.map(
+            median_filter, keep_attrs=True, args=(window_size, min_periods, binary)
+        )
+    if min_periods is None:
+        min_periods = window_size**2
+    kernel = majority_filter_kernel if binary else median_filter_kernel
+    kwargs = {"window_size": window_size, "min_periods": min_periods}
+    nodata = np.nan
+    if np.issubdtype(dc.dtype, np.integer) and "_FillValue" in dc.attrs:
+        nodata = dc.attrs["_FillValue"]
+        kwargs.update(kernel=kernel, nodata=nodata)
+        kernel = encoded_filter_kernel
+
+    def filter_(data):
+        if isinstance(data, da.Array):
+            depth = {data.ndim - 2: window_size // 2, data.ndim - 1: window_size // 2}
+            return data.map_overlap(
+                constant_filter_kernel,
+                depth=depth,
+                boundary=nodata,
+                # an explicit meta, so that the kernel is not called on an
+                # empty block while the graph is built
+                meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+                kernel=kernel,
+                nodata=nodata,
+                kwargs=kwargs,
+            )
+        return kernel(data, **kwargs)
+
+    filtered = xr.apply_ufunc(
+        filter_,
+        dc,
+        input_core_dims=[["y", "x"]],
+        output_core_dims=[["y", "x"]],
+        dask="allowed",
+        keep_attrs=True,
     )
+    return filtered.transpose(*dc.dims)
+
+
+def median_filter_kernel(block, window_size, min_periods):
+    """NaN-aware moving median over the last two axes of a numpy array.
+
+    Rows are processed in strips to bound the size of the windowed copy.
+    """
+    before, after = window_size // 2, window_size - 1 - window_size // 2
+    pad = [(0, 0)] * (block.ndim - 2) + [(before, after)] * 2
+    dtype = np.promote_types(block.dtype, np.float32)
+    padded = np.pad(block.astype(dtype, copy=False), pad, constant_values=np.nan)
+    filtered = np.empty(block.shape, dtype=padded.dtype)
+
+    n_rows, n_cols = block.shape[-2:]
+    strip = max(1, 2**22 // max(1, np.prod(block.shape[:-2]) * n_cols * window_size**2))
+    for start in range(0, n_rows, strip):
+        stop = min(start + strip, n_rows)
+        windows = sliding_window_view(
+            padded[..., start : stop + window_size - 1, :],
+            (window_size, window_size),
+            axis=(-2, -1),
+        ).reshape(*block.shape[:-2], stop - start, n_cols, window_size**2)
+        if min_periods == window_size**2:
+            # windows with a NaN are masked anyway, so no need for nanmedian
+            median = np.median(windows, axis=-1)
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                median = np.nanmedian(windows, axis=-1)
+            median[np.sum(~np.isnan(windows), axis=-1) < min_periods] = np.nan
+        filtered[..., start:stop, :] = median
+    return filtered.astype(block.dtype, copy=False)
+
+
+def constant_filter_kernel(block, kernel, nodata, kwargs):
+    """Apply a filter kernel to a block with overlap unless it is constant.
 
-    wait(flood_output)
+    Blocks without any valid pixel, or without missing pixels and with only
+    one value, are returned as they are: every window of them would hold just
+    that value. The overlap with the neighbouring blocks, or the nodata border
+    of the array, has to be part of ``block`` for this to hold at its edges.
+    """
+    missing = is_missing(block, nodata)
+    if missing.all() and kwargs["min_periods"] > 0:
+        count_skipped("median_filter")
+        return block.copy()
+    if not missing.any() and (block == block.flat[0]).all():
+        count_skipped("median_filter")
+        return block.copy()
+    return kernel(block, **kwargs)
 
-    return flood_output
+
+def encoded_filter_kernel(block, kernel, nodata, **kwargs):
+    """Apply a filter kernel to integer data with ``nodata`` as missing value."""
+    filtered = kernel(np.where(block == nodata, np.float32(np.nan), block), **kwargs)
+    filtered = np.where(np.isnan(filtered), nodata, np.floor(filtered + 0.5))
+    return filtered.astype(block.dtype)
+
+
+def majority_filter_kernel(block, window_size, min_periods):
+    """Moving median of an array of 0, 1 and NaN by majority vote.
+
+    A window with ``n`` valid pixels of which ``k`` are 1 has median 1 if
+    ``2k > n``, 0 if ``2k < n`` and 0.5 on a tie.
+    """
+    valid = ~np.isnan(block)
+    count = _window_sum(valid, window_size)
+    flooded = _window_sum(valid & (block == 1), window_size)
+
+    filtered = (2 * flooded > count).astype(block.dtype)
+    filtered[2 * flooded == count] = 0.5
+    filtered[count < min_periods] = np.nan
+    return filtered.astype(block.dtype, copy=False)
+
+
+def _window_sum(values, window_size):
+    """Moving window sum over the last two axes from an integral image."""
+    before, after = window_size // 2, window_size - 1 - window_size // 2
+    pad = [(0, 0)] * (values.ndim - 2) + [(before + 1, after)] * 2
+    integral = np.pad(values.astype(np.int32), pad)
+    integral = integral.cumsum(axis=-2).cumsum(axis=-1)
+    return (
+        integral[..., window_size:, window_size:]
+        - integral[..., :-window_size, window_size:]
+        - integral[..., window_size:, :-window_size]
+        + integral[..., :-window_size, :-window_size]
+    )
 
 
 def calc_water_likelihood(dc):
@@ -39,22 +202,67 @@ def calc_water_likelihood(dc):
 
 
 def harmonic_expected_backscatter(dc):
-    w = np.pi * 2 / 365
+    """Expected land backscatter of the harmonic model on the day of year.
+
+    The six harmonic terms are looked up per time step in
+    ``HARMONIC_BASIS`` and combined with the coefficients in one pass over
+    every chunk, see ``expected_backscatter``.
+    """
+    return xr.apply_ufunc(
+        expected_backscatter,
+        dc.M0,
+        dc.S1,
+        dc.C1,
+        dc.S2,
+        dc.C2,
+        dc.S3,
+        dc.C3,
+        harmonic_basis(dc.time.dt.dayofyear),
+        input_core_dims=[[]] * 7 + [["harmonic"]],
+        dask="parallelized",
+        output_dtypes=[dc.M0.dtype],
+    )
 
-    t = dc.time.dt.dayofyear
-    wt = w * t
 
-    M0 = dc.M0
-    S1 = dc.S1
-    S2 = dc.S2
-    S3 = dc.S3
-    C1 = dc.C1
-    C2 = dc.C2
-    C3 = dc.C3
-    hm_c1 = (M0 + S1 * np.sin(wt)) + (C1 * np.cos(wt))
-    hm_c2 = (hm_c1 + S2 * np.sin(2 * wt)) + C2 * np.cos(2 * wt)
-    hm_c3 = (hm_c2 + S3 * np.sin(3 * wt)) + C3 * np.cos(3 * wt)
-    return hm_c3
+def _harmonic_table(doy):
+    wt = np.pi * 2 / 365 * doy
+    return np.stack(
+        [
+            np.sin(wt),
+            np.cos(wt),
+            np.sin(2 * wt),
+            np.cos(2 * wt),
+            np.sin(3 * wt),
+            np.cos(3 * wt),
+        ],
+        axis=-1,
+    )
+
+
+# sin and cos of one to three times the yearly phase, row ``doy - 1`` per day
+HARMONIC_BASIS = _harmonic_table(np.arange(1, 367))
+
+
+def harmonic_basis(doy):
+    """Rows of ``HARMONIC_BASIS`` for the days of year ``doy``, along ``harmonic``."""
+    return xr.DataArray(
+        HARMONIC_BASIS[np.asarray(doy) - 1],
+        dims=(*doy.dims, "harmonic"),
+        coords=doy.coords,
+    )
+
+
+def expected_backscatter(m0, s1, c1, s2, c2, s3, c3, basis):
+    """Dot product of the harmonic coefficients with the rows of the basis.
+
+    The terms are added in place, in the order of the harmonic model, so a
+    single block sized array is allocated besides one product at a time.
+    """
+    basis = basis.astype(np.result_type(m0, s1), copy=False)
+    hbsc = m0 + s1 * basis[..., 0]
+    for coefficient, k in ((c1, 1), (s2, 2), (c2, 3), (s3, 4), (c3, 5)):
+        hbsc += coefficient * basis[..., k]
+    return hbsc
 
 
 def bayesian_flood_decision(dc):
@@ -73,6 +281,20 @@ def bayesian_flood_probability(dc):
     return (f_prob * 0.5) / evidence
 
 
+def bayesian_flood_log_odds(dc):
+    """Log-odds of flood, positive where ``bayesian_flood_decision`` is 1."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return xr.apply_ufunc(
+            flood_log_odds,
+            dc.sig0,
+            dc.STD,
+            dc.wbsc,
+            dc.hbsc,
+            dask="parallelized",
+            output_dtypes=[dc.sig0.dtype],
+        )
+
+
 def calc_prior_probability(dc):
     nf_std = 2.754041
     sig0 = dc.sig0
@@ -88,3 +310,188 @@ def calc_prior_probability(dc):
     )
 
     return f_prob, nf_prob
+
+
+def classify_flood_dc(dc):
+    """Fused Bayesian classification of a flood datacube.
+
+    Single pass alternative to chaining ``calc_water_likelihood``,
+    ``harmonic_expected_backscatter``, ``bayesian_flood_decision``,
+    ``bayesian_flood_probability`` and the masks of ``post_processing``. Every
+    chunk of sig0, MPLIA and the harmonic parameters is read once and all
+    layers are derived from it in ``bayesian_flood_kernel``.
+
+    Returns a Dataset with the raw ``decision``, the posterior probabilities
+    ``f_post_prob`` and ``nf_post_prob``, the flood ``log_odds`` and the
+    boolean ``mask`` of pixels that pass the post-processing filters.
+    """
+    dc = select_orbits(dc)
+    decision, f_post_prob, nf_post_prob, log_odds, mask = xr.apply_ufunc(
+        bayesian_flood_kernel,
+        dc.sig0,
+        dc.MPLIA,
+        dc.STD,
+        dc.M0,
+        dc.S1,
+        dc.S2,
+        dc.S3,
+        dc.C1,
+        dc.C2,
+        dc.C3,
+        dc.time.dt.dayofyear,
+        output_core_dims=[[], [], [], [], []],
+        dask="parallelized",
+        output_dtypes=[dc.sig0.dtype] * 4 + [bool],
+    )
+    return xr.Dataset(
+        {
+            "decision": decision,
+            "f_post_prob": f_post_prob,
+            "nf_post_prob": nf_post_prob,
+            "log_odds": log_odds,
+            "mask": mask,
+        }
+    )
+
+
+def bayesian_flood_kernel(sig0, mplia, std, m0, s1, s2, s3, c1, c2, c3, doy):
+    """Classify one block of numpy arrays, see ``classify_flood_dc``.
+
+    Temporaries are updated in place so that only a handful of block sized
+    arrays are alive at any time. All layers keep the precision of ``sig0``.
+
+    Blocks in which sig0, the incidence angle, the standard deviation or the
+    mean of the harmonic model is missing everywhere, such as swath edges and
+    orbit gaps, can not be classified and are returned as NaN right away.
+    """
+    if any(np.isnan(layer).all() for layer in (sig0, mplia, std, m0)):
+        count_skipped("classify")
+        layers = (sig0, mplia, std, m0, s1, s2, s3, c1, c2, c3, doy)
+        shape = np.broadcast_shapes(*(np.shape(layer) for layer in layers))
+        empty = np.full(shape, np.nan, dtype=sig0.dtype)
+        return empty, empty.copy(), empty.copy(), empty.copy(), np.zeros(shape, bool)
+
+    wbsc = mplia * -0.394181 + -4.142015
+
+    basis = HARMONIC_BASIS[doy - 1].astype(sig0.dtype, copy=False)
+    hbsc = expected_backscatter(m0, s1, c1, s2, c2, s3, c3, basis)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        log_odds = flood_log_odds(sig0, std, wbsc, hbsc)
+
+        decision = np.greater(log_odds, 0).astype(sig0.dtype)
+        decision[np.isnan(log_odds)] = np.nan
+
+        # with equal priors the posterior is the logistic function of the log-odds
+        f_post_prob = np.negative(log_odds)
+        np.exp(f_post_prob, out=f_post_prob)
+        f_post_prob += 1
+        np.reciprocal(f_post_prob, out=f_post_prob)
+        nf_post_prob = np.subtract(1, f_post_prob)
+
+    mask = flood_validity_mask(sig0, mplia, std, wbsc, hbsc, f_post_prob)
+    return decision, f_post_prob, nf_post_prob, log_odds, mask
+
+
+def flood_log_odds(sig0, std, wbsc, hbsc):
+    """Log-likelihood ratio of flood and non-flood for numpy arrays.
+
+    The logarithm of the ratio of the two Gaussian densities of
+    ``calc_prior_probability``, evaluated without exponentials, so that it does
+    not underflow for backscatter far from both distributions.
+    """
+    nf_std = 2.754041
+    log_odds = np.subtract(sig0, hbsc)
+    np.square(log_odds, out=log_odds)
+    water = np.subtract(sig0, wbsc)
+    np.square(water, out=water)
+    log_odds -= water
+    log_odds *= 0.5 / nf_std**2
+    log_odds -= np.log(std, out=water)
+    log_odds += math.log(nf_std)
+    return log_odds
+
+
+def flood_validity_mask(sig0, mplia, std, wbsc, hbsc, f_post_prob):
+    """Pixels that pass the post-processing filters of the flood decision.
+
+    Excludes pixels with an incidence angle outside 27-48 degrees, pixels where
+    the land and water distributions are not separable, backscatter outliers and
+    decisions with a low flood posterior probability. Works on numpy arrays as
+    well as on xarray objects. The remaining filters are skipped for numpy
+    blocks that lie entirely outside the incidence angle range.
+    """
+    nf_std = 2.754041
+    mask = (mplia >= 27) & (mplia <= 48)
+    if isinstance(mask, np.ndarray) and not mask.any():
+        count_skipped("mask")
+        return np.zeros(np.shape(f_post_prob), dtype=bool)
+    mask &= hbsc > (wbsc + 0.5 * nf_std)
+    mask_land_outliers = (sig0 > hbsc - 3 * std) & (sig0 < hbsc + 3 * std)
+    mask_water_outliers = sig0 < wbsc + 3 * nf_std
+    mask &= mask_land_outliers | mask_water_outliers
+    mask &= f_post_prob > 0.8
+    return mask
+
+
+AGGREGATES = ("extent", "frequency", "first_detection")
+
+
+def temporal_aggregates(decision, aggregates=AGGREGATES):
+    """Summaries over time of a flood decision of 0, 1 and NaN.
+
+    - "extent": maximum extent, 1 where flood was observed at least once
+    - "frequency": number of flood observations
+    - "first_detection": microseconds from the first time step to the first
+      flood observation, see ``detection_time``
+
+    Pixels that were never observed, or for "first_detection" never flooded,
+    are NaN. Dask arrays are reduced with trees that combine
+    ``aggregation: split_every`` partial results at a time, so every time
+    chunk is released as soon as it is folded into the partial results.
+    """
+    axis = decision.get_axis_num("time")
+    template = decision.isel(time=0, drop=True)
+
+    def reduce(data, ufunc):
+        return template.copy(data=tree_reduce(data, ufunc, axis))
+
+    result = {}
+    extent = reduce(decision.data, np.fmax)
+    if "extent" in aggregates:
+        result["extent"] = extent
+    if "frequency" in aggregates:
+        flooded = xr.where(decision == 1, 1, 0, keep_attrs=False)
+        result["frequency"] = reduce(flooded.data, np.add).where(extent.notnull())
+    if "first_detection" in aggregates:
+        offset = (decision.time - decision.time[0]) / np.timedelta64(1, "us")
+        detection = xr.where(decision == 1, offset, np.nan).transpose(*decision.dims)
+        result["first_detection"] = reduce(detection.data, np.fmin).assign_attrs(
+            start=str(decision.time.values[0])
+        )
+    return result
+
+
+def tree_reduce(data, ufunc, axis):
+    """Reduce an array along ``axis`` with a binary ufunc such as ``np.fmax``."""
+    if not isinstance(data, da.Array):
+        return ufunc.reduce(data, axis=axis)
+    return da.reduction(
+        data,
+        chunk=partial(_ufunc_reduce, ufunc),
+        aggregate=partial(_ufunc_reduce, ufunc),
+        axis=axis,
+        dtype=data.dtype,
+        split_every=config["aggregation"]["split_every"],
+    )
+
+
+def _ufunc_reduce(ufunc, block, axis, keepdims):
+    return ufunc.reduce(block, axis=axis, keepdims=keepdims)
+
+
+def detection_time(first_detection):
+    """Datetimes, NaT where never flooded, of a "first_detection" aggregate."""
+    start = np.datetime64(first_detection.attrs["start"], "ns")
+    offset = (first_detection * 1e3).astype("timedelta64[ns]")
+    return (start + offset).rename(first_detection.name).drop_attrs()
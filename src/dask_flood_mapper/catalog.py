@@ -1,27 +1,254 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+
+import pystac
 import pystac_client
+from appdirs import user_cache_dir
+from pystac_client.conformance import ConformanceClasses
+from pystac_client.item_search import ItemSearch
+from pystac_client.stac_api_io import StacApiIO
+from pystac.utils import str_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dask_flood_mapper.stac_config import load_config
 
 config = load_config()
 
+SIG0_COLLECTION = "SENTINEL1_SIG0_20M"
+STATIC_COLLECTIONS = ("SENTINEL1_HPAR", "SENTINEL1_MPLIA")
+
+_catalog_lock = Lock()
+
 
 def initialize_catalog():
-    eodc_catalog = pystac_client.Client.open(config["api"])
-    return eodc_catalog
+    with _catalog_lock:
+        return open_catalog(config["api"])
+
+
+@lru_cache
+def open_catalog(api):
+    return pystac_client.Client.open(api, stac_io=pooled_stac_io())
+
+
+def pooled_stac_io():
+    """STAC API IO on one HTTP session shared by all concurrent searches.
+
+    The session keeps up to ``catalog: pool_size`` connections open and
+    retries failed requests, including rate limits and server errors, with
+    exponential backoff.
+    """
+    catalog_config = config["catalog"]
+    retry = Retry(
+        total=catalog_config["retries"],
+        backoff_factor=catalog_config["backoff"],
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+    )
+    stac_io = StacApiIO(max_retries=None)
+    adapter = HTTPAdapter(
+        pool_connections=catalog_config["pool_size"],
+        pool_maxsize=catalog_config["pool_size"],
+        max_retries=retry,
+    )
+    stac_io.session.mount("http://", adapter)
+    stac_io.session.mount("https://", adapter)
+    return stac_io
+
+
+@lru_cache
+def search_executor():
+    return ThreadPoolExecutor(
+        max_workers=config["catalog"]["workers"], thread_name_prefix="stac-search"
+    )
+
+
+def submit_search(collection, bbox, datetime=None, orbits=None):
+    """Run ``search_items`` in a background thread.
+
+    Returns a ``concurrent.futures.Future`` of the items, so that searches of
+    several collections and the loading of data can overlap.
+    """
+    return search_executor().submit(search_items, collection, bbox, datetime, orbits)
 
 
 def initialize_search(eodc_catalog, bbox, time_range):
     search = eodc_catalog.search(
-        collections="SENTINEL1_SIG0_20M",
+        collections=SIG0_COLLECTION,
         bbox=bbox,
         datetime=time_range,
     )
     return search
 
 
-def search_parameters(eodc_catalog, bbox, collections):
+def search_parameters(eodc_catalog, bbox, collections, orbits=None):
+    query = None
+    if orbits is not None and eodc_catalog.conforms_to(ConformanceClasses.QUERY):
+        # let the catalog drop items of unused orbits server-side
+        query = orbit_query(orbits)
     search = eodc_catalog.search(
         collections=collections,  # "SENTINEL1_HPAR" or "SENTINEL1_MPLIA"
         bbox=bbox,
+        query=query,
     )
 
     return search
+
+
+def orbit_query(orbits):
+    """STAC query on the relative orbits of orbit names such as "A15"."""
+    relative_orbits = sorted(
+        {int(re.search(r"\d+$", orbit).group()) for orbit in orbits}
+    )
+    return {"sat:relative_orbit": {"in": relative_orbits}}
+
+
+def search_items(collection, bbox, datetime=None, orbits=None):
+    """Search a collection, served from the STAC cache when possible.
+
+    The catalog is only opened when the search is not cached yet. Sigma naught
+    searches expire after the configured TTL, whereas the harmonic parameters
+    and incidence angles do not depend on time and are cached indefinitely.
+    """
+    cache = stac_cache()
+    key = cache.key(collection, bbox, datetime, orbits)
+    ttl = None if collection in STATIC_COLLECTIONS else cache.ttl
+    items = cache.get(key, ttl=ttl)
+    if items is None:
+        eodc_catalog = initialize_catalog()
+        if collection == SIG0_COLLECTION:
+            search = initialize_search(eodc_catalog, bbox, datetime)
+        else:
+            search = search_parameters(eodc_catalog, bbox, collection, orbits)
+        items = search.item_collection()
+        cache.put(key, items)
+    return items
+
+
+def stream_items(bbox, datetime, days=None):
+    """Sigma naught items of a time range in consecutive windows of ``days``.
+
+    Yields the closed time range of every window, oldest first, together with
+    its items, so that a long or open-ended range is never searched as a
+    whole. Windows without items are skipped. An open end is the current
+    time. ``days`` defaults to ``streaming: days`` of the configuration.
+    """
+    days = days or config["streaming"]["days"]
+    start, end = search_interval(datetime)
+    if start is None:
+        raise ValueError(f"Streaming needs a start of the time range, got {datetime}")
+    if end is None:
+        end = dt.datetime.now(dt.timezone.utc)
+    window = dt.timedelta(days=days)
+    while start <= end:
+        stop = min(start + window - dt.timedelta(microseconds=1), end)
+        time_range = f"{format_datetime(start)}/{format_datetime(stop)}"
+        items = search_items(SIG0_COLLECTION, bbox, time_range)
+        if len(items) > 0:
+            yield time_range, items
+        start += window
+
+
+def search_interval(datetime):
+    """Start and end of a STAC datetime string, None where it is open."""
+    search = ItemSearch(f"{config['api']}/search", datetime=datetime)
+    bounds = search.get_parameters()["datetime"].split("/")
+    # datetime.fromisoformat only accepts a trailing "Z" from Python 3.11 on
+    return tuple(
+        None if bound == ".." else str_to_datetime(bound)
+        for bound in (bounds[0], bounds[-1])
+    )
+
+
+def format_datetime(timestamp):
+    return timestamp.astimezone(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def invalidate_stac_cache(collection=None):
+    """Remove cached searches of one collection, or of all collections."""
+    stac_cache().invalidate(collection)
+
+
+@lru_cache
+def stac_cache():
+    cache_config = config["cache"]
+    directory = cache_config["directory"] or user_cache_dir("dask_flood_mapper")
+    return StacCache(Path(directory) / "stac", **cache_config["stac"])
+
+
+class StacCache:
+    """On-disk cache of STAC item collections with size-bounded LRU eviction.
+
+    Every search is stored as one JSON file. Reading an entry refreshes its
+    modification time, which is used to evict the least recently used entries
+    once the cache grows beyond ``max_size`` megabytes.
+    """
+
+    def __init__(self, directory, enabled=True, ttl=3600, max_size=100):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_size = max_size * 1e6
+
+    def key(self, collection, bbox, datetime=None, orbits=None):
+        orbits = None if orbits is None else sorted(set(orbits))
+        # the same search of another catalog returns other items
+        search = json.dumps([config["api"], list(bbox), datetime, orbits], default=str)
+        return f"{collection}-{hashlib.sha256(search.encode()).hexdigest()[:32]}"
+
+    def get(self, key, ttl=None):
+        path = self.directory / f"{key}.json"
+        if not self.enabled or not path.exists():
+            return None
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if ttl is not None and time.time() - entry["created"] > ttl:
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        return pystac.ItemCollection.from_dict(entry["items"], preserve_dict=False)
+
+    def put(self, key, items):
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry = {"created": time.time(), "items": items.to_dict()}
+        # write to a temporary file first so readers never see partial entries
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            json.dump(entry, file)
+        os.replace(file.name, self.directory / f"{key}.json")
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by a concurrent search
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            size -= entry_size
+            path.unlink(missing_ok=True)
+
+    def invalidate(self, collection=None):
+        pattern = "*.json" if collection is None else f"{collection}-*.json"
+        for path in self.directory.glob(pattern):
+            path.unlink(missing_ok=True)
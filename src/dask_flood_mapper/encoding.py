@@ -0,0 +1,50 @@
+import numpy as np
+
+from dask_flood_mapper.catalog import config
+
+DECISION_DTYPES = ("float", "uint8")
+PROBABILITY_DTYPES = ("float", "float16", "uint8")
+NODATA = 255
+PROBABILITY_SCALE = 0.005  # uint8 probabilities in steps of half a percent
+
+
+def encode_decision(decision, dtype=None):
+    """Store the flood decision with the configured ``output: decision`` dtype.
+
+    "float" keeps 0, 1 and NaN, "uint8" stores 0 and 1 with ``NODATA`` for
+    missing pixels, declared as CF ``_FillValue`` so that ``xr.decode_cf``
+    restores the float decision.
+    """
+    dtype = dtype or config["output"]["decision"]
+    if dtype not in DECISION_DTYPES:
+        raise ValueError(
+            f"Unknown decision dtype {dtype}, choose from {', '.join(DECISION_DTYPES)}"
+        )
+    if dtype == "float":
+        return decision
+    encoded = decision.fillna(NODATA).astype(np.uint8)
+    encoded.attrs["_FillValue"] = np.uint8(NODATA)
+    return encoded
+
+
+def encode_probability(probability, dtype=None):
+    """Store a probability with the configured ``output: probability`` dtype.
+
+    "float" keeps the computed precision and "float16" halves or quarters it.
+    "uint8" stores the probability in steps of ``PROBABILITY_SCALE`` with
+    ``NODATA`` for missing pixels and the CF ``scale_factor`` and
+    ``_FillValue`` attributes to decode it with ``xr.decode_cf``.
+    """
+    dtype = dtype or config["output"]["probability"]
+    if dtype not in PROBABILITY_DTYPES:
+        raise ValueError(
+            f"Unknown probability dtype {dtype}, "
+            f"choose from {', '.join(PROBABILITY_DTYPES)}"
+        )
+    if dtype == "float":
+        return probability
+    if dtype == "float16":
+        return probability.astype(np.float16)
+    encoded = (probability / PROBABILITY_SCALE).round().fillna(NODATA).astype(np.uint8)
+    encoded.attrs.update(scale_factor=PROBABILITY_SCALE, _FillValue=np.uint8(NODATA))
+    return encoded
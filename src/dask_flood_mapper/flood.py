@@ -1,18 +1,27 @@
+import numpy as np
+import xarray as xr
 from dask_flood_mapper.calculation import (
-    calc_water_likelihood,
-    harmonic_expected_backscatter,
-    bayesian_flood_decision,
-    bayesian_flood_probability,
+    AGGREGATES,
     calculate_flood_dc,
+    classify_flood_dc,
+    detection_time,
     remove_speckles,
+    temporal_aggregates,
 )
+from dask_flood_mapper.encoding import encode_decision, encode_probability
+from dask_flood_mapper.materialize import materialize_strategy
+from dask_flood_mapper.reference import apply_reference_mask
+from dask_flood_mapper.writers import to_cog, to_zarr
 from dask_flood_mapper.catalog import (
-    initialize_catalog,
-    initialize_search,
-    search_parameters,
+    SIG0_COLLECTION,
+    STATIC_COLLECTIONS,
+    search_items,
+    stream_items,
+    submit_search,
 )
 from dask_flood_mapper.processing import (
-    post_processing,
+    extract_orbit_names,
+    filter_items_by_orbit,
     prepare_dc,
     process_sig0_dc,
     process_datacube,
@@ -27,6 +36,8 @@ chunks = config["base"]["chunks"]
 groupby = config["base"]["groupby"]
 BANDS_SIG0 = "VV"
 BANDS_PLIA = "MPLIA"
+OUTPUTS = ("decision", "probability", "nf_probability")
+OPTIONAL_OUTPUTS = ("log_odds",) + AGGREGATES
 
 
 def decision(bbox, datetime):
@@ -56,7 +67,8 @@ def decision(bbox, datetime):
 
     Returns
     -------
-        flood decision : xarray.DataArray of 0 (non-flood) and 1 (flood)
+        flood decision : xarray.DataArray of 0 (non-flood) and 1 (flood), as
+        uint8 with 255 for no data if the ``output: decision`` setting is "uint8"
 
     See also
     --------
@@ -123,15 +135,7 @@ def decision(bbox, datetime):
     >>>
     """
 
-    sig0_dc, hpar_dc, plia_dc = preprocess(bbox, datetime)
-    flood_dc = calculate_flood_dc(sig0_dc, plia_dc, hpar_dc)
-    flood_dc["wbsc"] = calc_water_likelihood(flood_dc)  # Water
-    flood_dc["hbsc"] = harmonic_expected_backscatter(flood_dc)  # Land
-    flood_dc["decision"] = bayesian_flood_decision(flood_dc)
-    flood_dc["f_post_prob"] = bayesian_flood_probability(flood_dc)
-    flood_dc["nf_post_prob"] = 1 - flood_dc["f_post_prob"]
-    flood_output = post_processing(flood_dc)
-    return reproject_equi7grid(remove_speckles(flood_output), bbox=bbox)
+    return classify(bbox, datetime, outputs=("decision",)).decision
 
 
 def probability(bbox, datetime):
@@ -230,32 +234,492 @@ def probability(bbox, datetime):
         _FillValue:  nan
     >>>
     """
+    return classify(bbox, datetime, outputs=("probability",)).probability
+
+
+def decision_to_zarr(bbox, datetime, store, append=False):
+    """
+    Write the flood decision to a Zarr store
+
+    The decision is computed and written chunk by chunk on the workers, so
+    its size is not limited by the memory of the client. Requires zarr.
+
+    Parameters
+    ----------
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, see ``decision``
+    datetime: string
+        Datetime string, see ``decision``
+    store: string or zarr store
+        Path or store reachable from the workers, holding the variable
+        ``decision``
+    append: bool
+        Extend an existing store along time instead of replacing it; time
+        steps already in the store are skipped
+
+    See also
+    --------
+    decision, decision_to_cog
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>>
+    >>>
+    >>> bbox = [12.3, 54.3, 13.1, 54.6]
+    >>> flood.decision_to_zarr(bbox, "2022-10-11/2022-10-25", "flood.zarr")
+    >>> flood.decision_to_zarr(bbox, "2022-10-26/2022-11-10", "flood.zarr", True)
+    """
+    layers = classify(bbox, datetime, outputs=("decision",))
+    to_zarr(layers, store, append=append)
+
+
+def probability_to_zarr(bbox, datetime, store, append=False):
+    """
+    Write the flood probability to a Zarr store, see ``decision_to_zarr``
+    """
+    layers = classify(bbox, datetime, outputs=("probability",))
+    to_zarr(layers, store, append=append)
+
+
+def decision_to_cog(bbox, datetime, directory, append=False):
+    """
+    Write the flood decision to Cloud Optimized GeoTIFFs
+
+    Writes one compressed COG with internal overviews per time step, named
+    ``decision_{time:%Y%m%dT%H%M%S}.tif``. The chunks are written on the
+    workers, so the size of the maps is not limited by the memory of the
+    client.
+
+    Parameters
+    ----------
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, see ``decision``
+    datetime: string
+        Datetime string, see ``decision``
+    directory: string or pathlib.Path
+        Output directory reachable from the workers
+    append: bool
+        Skip time steps whose file already exists
+
+    Returns
+    -------
+        paths : list of pathlib.Path of the written files
+
+    See also
+    --------
+    decision, decision_to_zarr
+    """
+    layers = classify(bbox, datetime, outputs=("decision",))
+    return to_cog(layers, directory, append=append)
+
+
+def probability_to_cog(bbox, datetime, directory, append=False):
+    """
+    Write the flood probability to Cloud Optimized GeoTIFFs, see
+    ``decision_to_cog``
+    """
+    layers = classify(bbox, datetime, outputs=("probability",))
+    return to_cog(layers, directory, append=append)
+
+
+def classify(bbox, datetime, outputs=OUTPUTS):
+    """
+    Bayesian Flood Classification
+
+    Derive several flood layers from one shared computation. The Sentinel-1
+    radar images, harmonic parameters and projected incidence angles are
+    searched, loaded and merged only once, whereas calling ``decision`` and
+    ``probability`` separately repeats all of these steps.
+
+    Parameters
+    ----------
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, consisting of minimum longitude, minimum
+        latitude, maximum longitude, maximum latitude
+    datetime: string
+        Datetime string, see ``decision``
+    outputs: tuple of string
+        Layers to return, by default the first three of:
+
+          - "decision": flood decision as returned by ``decision``
+          - "probability": flood probability as returned by ``probability``
+          - "nf_probability": probability of non-flood
+          - "log_odds": natural logarithm of the odds of flood, positive
+            where the unfiltered decision is flood
+          - "extent", "frequency", "first_detection": summaries of the
+            decision over time without a time dimension, see ``aggregate``
+
+    Returns
+    -------
+        flood layers : xarray.Dataset with one variable per requested output
+
+    See also
+    --------
+    decision, probability
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>>
+    >>>
+    >>> time_range = "2022-10-11/2022-10-25"
+    >>> bbox = [12.3, 54.3, 13.1, 54.6]
+    >>> flood.classify(bbox, time_range, outputs=("decision", "probability"))
+    <xarray.Dataset> Size: 375MB
+    Dimensions:      (time: 8, y: 1048, x: 2793)
+    Coordinates:
+    * x            (x) float64 22kB 12.3 12.3 12.3 12.3 ... 13.1 13.1 13.1 13.1
+    * y            (y) float64 8kB 54.6 54.6 54.6 54.6 ... 54.3 54.3 54.3 54.3
+    * time         (time) datetime64[ns] 64B 2022-10-11T05:25:01 ... 2022-10-23...
+        spatial_ref  int64 8B 0
+    Data variables:
+        decision     (time, y, x) float64 187MB dask.array<chunksize=(...)>
+        probability  (time, y, x) float64 187MB dask.array<chunksize=(...)>
+    >>>
+    """
+    check_outputs(outputs)
     sig0_dc, hpar_dc, plia_dc = preprocess(bbox, datetime)
+    return flood_layers(sig0_dc, hpar_dc, plia_dc, bbox, outputs)
+
+
+def aggregate(bbox, datetime, aggregates=AGGREGATES):
+    """
+    Summaries of the Bayesian Flood Decision over a time range
+
+    The decision is reduced over time chunk by chunk while it is computed, so
+    the ``(time, y, x)`` decision cube is never held as a whole: the pipeline
+    is built as one lazy graph and every time step is folded into the partial
+    results of a tree reduction as soon as it is classified. Peak memory
+    stays close to that of a few time steps, however long the range.
+
+    Parameters
+    ----------
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, see ``decision``
+    datetime: string
+        Datetime string, see ``decision``
+    aggregates: tuple of string
+        Summaries to return, by default all of:
+
+          - "extent": maximum flood extent, 1 where flood was observed at
+            least once, 0 where only non-flood was observed, encoded like
+            the decision
+          - "frequency": number of flood observations per pixel
+          - "first_detection": date of the first flood observation, NaT where
+            no flood was observed
+
+    Returns
+    -------
+        flood aggregates : xarray.Dataset with one (y, x) variable per
+        requested summary, NaN where no observation was made
+
+    See also
+    --------
+    decision, classify
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>>
+    >>>
+    >>> bbox = [12.3, 54.3, 13.1, 54.6]
+    >>> flood.aggregate(bbox, "2022-01-01/2022-12-31").compute()
+    """
+    unknown = set(aggregates) - set(AGGREGATES)
+    if unknown:
+        raise ValueError(
+            f"Unknown aggregates {sorted(unknown)}, choose from {', '.join(AGGREGATES)}"
+        )
+    with materialize_strategy("lazy"):
+        return classify(bbox, datetime, outputs=aggregates)
+
+
+def check_outputs(outputs):
+    unknown = set(outputs) - set(OUTPUTS + OPTIONAL_OUTPUTS)
+    if unknown:
+        raise ValueError(
+            f"Unknown outputs {sorted(unknown)}, "
+            f"choose from {', '.join(OUTPUTS + OPTIONAL_OUTPUTS)}"
+        )
+
+
+def check_time_series_outputs(outputs):
+    """Reject unknown outputs and summaries without a time dimension."""
+    check_outputs(outputs)
+    summaries = [name for name in outputs if name in AGGREGATES]
+    if summaries:
+        raise ValueError(
+            f"Outputs {summaries} have no time dimension, use flood.aggregate"
+        )
+
+
+def flood_layers(sig0_dc, hpar_dc, plia_dc, bbox, outputs=OUTPUTS, grid=None):
+    check_outputs(outputs)
     flood_dc = calculate_flood_dc(sig0_dc, plia_dc, hpar_dc)
-    flood_dc["wbsc"] = calc_water_likelihood(flood_dc)  # Water
-    flood_dc["hbsc"] = harmonic_expected_backscatter(flood_dc)  # Land
-    return reproject_equi7grid(bayesian_flood_probability(flood_dc), bbox=bbox)
+    flood_dc = classify_flood_dc(flood_dc)
+
+    layers = {}
+    decision = flood_dc.decision * flood_dc.mask
+    if "decision" in outputs:
+        layers["decision"] = remove_speckles(encode_decision(decision), binary=True)
+    if "probability" in outputs:
+        layers["probability"] = encode_probability(flood_dc.f_post_prob)
+    if "nf_probability" in outputs:
+        layers["nf_probability"] = encode_probability(flood_dc.nf_post_prob)
+    if "log_odds" in outputs:
+        layers["log_odds"] = flood_dc.log_odds
+    aggregates = [name for name in AGGREGATES if name in outputs]
+    if aggregates:
+        filtered = remove_speckles(decision, binary=True)
+        layers.update(temporal_aggregates(filtered, aggregates))
+    if "extent" in layers:
+        layers["extent"] = encode_decision(layers["extent"])
+
+    layers = reproject_equi7grid(xr.Dataset(layers), bbox=bbox, grid=grid)
+    if "first_detection" in layers:
+        layers["first_detection"] = detection_time(layers.first_detection)
+    return layers
+
+
+def decision_batch(requests):
+    """
+    Bayesian Flood Decision of many bounding boxes and time ranges at once
+
+    All sigma naught searches run concurrently on one catalog session, with
+    duplicate searches done once. Requests whose bounding boxes overlap share
+    a single load of the harmonic parameters and incidence angles of their
+    union. The graphs of all requests are then submitted together, so that
+    their tasks are scheduled side by side and shared tasks run only once.
+
+    Parameters
+    ----------
+    requests : list of tuple
+        Pairs of a bounding box and a datetime string, see ``decision``
+
+    Yields
+    ------
+        index : int of the request in ``requests``
+        flood decision : computed xarray.DataArray of the request, as
+        returned by ``decision``, in the order in which they finish
+
+    See also
+    --------
+    decision
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>>
+    >>>
+    >>> requests = [
+    ...     ([12.3, 54.3, 13.1, 54.6], "2022-10-11/2022-10-25"),
+    ...     ([12.8, 54.4, 13.4, 54.7], "2022-10-11/2022-10-25"),
+    ... ]
+    >>> for index, fd in flood.decision_batch(requests):
+    ...     fd.to_netcdf(f"flood_{index}.nc")
+    """
+    requests = [(list(bbox), datetime) for bbox, datetime in requests]
+    searches = {}
+    for bbox, datetime in requests:
+        key = (tuple(bbox), datetime)
+        if key not in searches:
+            searches[key] = submit_search(SIG0_COLLECTION, bbox, datetime)
+
+    with materialize_strategy("lazy"):
+        sig0_dcs = []
+        for bbox, datetime in requests:
+            items_sig0 = searches[(tuple(bbox), datetime)].result()
+            if len(items_sig0) == 0:
+                raise ValueError(
+                    f"No sigma naught data found within {bbox} at {datetime}"
+                )
+            sig0_dcs.append(preprocess_sig0(items_sig0, bbox))
+
+        layers = [None] * len(requests)
+        for group in overlapping_requests(requests, sig0_dcs):
+            bbox = union_bbox([requests[i][0] for i in group])
+            orbits = np.unique(np.concatenate([sig0_dcs[i][1] for i in group]))
+            static_searches = {
+                collection: submit_search(collection, bbox, orbits=orbits)
+                for collection in STATIC_COLLECTIONS
+            }
+            hpar_dc = preprocess_static(
+                static_searches["SENTINEL1_HPAR"].result(), bbox, orbits, BANDS_HPAR
+            )
+            plia_dc = preprocess_static(
+                static_searches["SENTINEL1_MPLIA"].result(), bbox, orbits, BANDS_PLIA
+            )
+            for i in group:
+                sig0_dc, orbit_sig0 = sig0_dcs[i]
+                used = np.unique(orbit_sig0)
+                layers[i] = flood_layers(
+                    sig0_dc,
+                    crop_to(hpar_dc.sel(orbit=used), sig0_dc),
+                    crop_to(plia_dc.sel(orbit=used), sig0_dc),
+                    requests[i][0],
+                    ("decision",),
+                )
+
+    yield from compute_as_completed([layer.decision for layer in layers])
+
+
+def overlapping_requests(requests, sig0_dcs):
+    """Indices of requests grouped by overlapping bounding boxes on one grid."""
+    groups = []
+    for i, (bbox, _) in enumerate(requests):
+        crs = sig0_dcs[i][0].odc.geobox.crs
+        joined = [
+            group
+            for group in groups
+            if group["crs"] == crs
+            and any(bboxes_overlap(bbox, requests[j][0]) for j in group["indices"])
+        ]
+        merged = {"crs": crs, "indices": [i]}
+        for group in joined:
+            merged["indices"] += group["indices"]
+            groups.remove(group)
+        groups.append(merged)
+    return [sorted(group["indices"]) for group in groups]
+
+
+def bboxes_overlap(bbox, other):
+    return (
+        bbox[0] <= other[2]
+        and other[0] <= bbox[2]
+        and bbox[1] <= other[3]
+        and other[1] <= bbox[3]
+    )
+
+
+def union_bbox(bboxes):
+    bboxes = np.asarray(bboxes, dtype=float)
+    return [*bboxes[:, :2].min(axis=0), *bboxes[:, 2:].max(axis=0)]
+
+
+def crop_to(dc, like):
+    """Part of ``dc`` on the grid of ``like``, which has to be aligned with it."""
+    transform = dc.odc.geobox.transform
+    like_transform = like.odc.geobox.transform
+    col, row = ~transform * (like_transform.c, like_transform.f)
+    col, row = round(col), round(row)
+    height, width = like.odc.geobox.shape
+    dc = dc.isel(y=slice(row, row + height), x=slice(col, col + width))
+    return dc.assign_coords(y=like.y, x=like.x)
+
+
+def compute_as_completed(collections):
+    """Compute all collections together, yielding each with its index once done.
+
+    On a distributed cluster all graphs are submitted at once; otherwise they
+    are computed one after the other.
+    """
+    try:
+        from distributed import as_completed, default_client
+
+        client = default_client()
+    except ValueError:  # no distributed client
+        for index, collection in enumerate(collections):
+            yield index, collection.compute()
+        return
+    futures = client.compute(collections)
+    # identical requests share one key and are computed once
+    indices = {}
+    for index, future in enumerate(futures):
+        indices.setdefault(future.key, []).append(index)
+    unique = {future.key: future for future in futures}
+    for future in as_completed(list(unique.values())):
+        result = future.result()
+        for index in indices[future.key]:
+            yield index, result
+
+
+def stream(bbox, datetime, outputs=OUTPUTS, days=None):
+    """
+    Bayesian Flood Classification of long or open-ended time ranges
+
+    Search, load and classify the time range in consecutive windows of
+    ``days``, so that neither the found items nor the task graph grow with
+    the length of the range. Every window is independent of the others and
+    can be computed and written out before the next one is searched.
+
+    Parameters
+    ----------
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, see ``decision``
+    datetime: string
+        Datetime string with a start, see ``decision``; open ranges such as
+        "2022-01-01/.." end at the current time
+    outputs: tuple of string
+        Layers to return, see ``classify``
+    days: int
+        Length of the time windows, ``streaming: days`` of the configuration
+        by default
+
+    Yields
+    ------
+        time range : string of the closed time range of the window
+        flood layers : xarray.Dataset of the window as returned by ``classify``
+
+    See also
+    --------
+    classify
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>>
+    >>>
+    >>> bbox = [12.3, 54.3, 13.1, 54.6]
+    >>> for time_range, layers in flood.stream(bbox, "2022-01-01/.."):
+    ...     layers.to_netcdf(f"flood_{time_range[:10]}.nc")
+    """
+    for time_range, items_sig0 in stream_items(bbox, datetime, days):
+        sig0_dc, hpar_dc, plia_dc = preprocess_items(items_sig0, bbox)
+        yield time_range, flood_layers(sig0_dc, hpar_dc, plia_dc, bbox, outputs)
 
 
 def preprocess(bbox, datetime):
-    eodc_catalog = initialize_catalog()
-    search = initialize_search(eodc_catalog, bbox, datetime)
+    items_sig0 = search_items(SIG0_COLLECTION, bbox, datetime)
+    return preprocess_items(items_sig0, bbox)
+
+
+def preprocess_items(items_sig0, bbox):
+    """Load and merge the sigma naught and static datacubes of sigma naught items.
+
+    The searches of the harmonic parameters and incidence angles only need the
+    orbits of the sigma naught items. They run in background threads, in
+    parallel to each other and to loading the sigma naught datacube.
+    """
+    orbits = np.unique(extract_orbit_names(items_sig0))
+    static_searches = {
+        collection: submit_search(collection, bbox, orbits=orbits)
+        for collection in STATIC_COLLECTIONS
+    }
 
-    items_sig0 = search.item_collection()
-    sig0_dc = prepare_dc(items_sig0, bbox, bands="VV")
-    sig0_dc, orbit_sig0 = process_sig0_dc(sig0_dc, items_sig0, bands="VV")
+    sig0_dc, orbit_sig0 = preprocess_sig0(items_sig0, bbox)
     print("sigma naught datacube processed")
 
-    search_hpar = search_parameters(eodc_catalog, bbox, collections="SENTINEL1_HPAR")
-    items_hpar = search_hpar.item_collection()
-    hpar_dc = prepare_dc(items_hpar, bbox, bands=BANDS_HPAR)
-    hpar_dc = process_datacube(hpar_dc, items_hpar, orbit_sig0, BANDS_HPAR)
+    items_hpar = static_searches["SENTINEL1_HPAR"].result()
+    hpar_dc = preprocess_static(items_hpar, bbox, orbit_sig0, BANDS_HPAR)
     print("harmonic parameter datacube processed")
 
-    search_plia = search_parameters(eodc_catalog, bbox, collections="SENTINEL1_MPLIA")
-    items_plia = search_plia.item_collection()
-    plia_dc = prepare_dc(items_plia, bbox, bands=BANDS_PLIA)
-    plia_dc = process_datacube(plia_dc, items_plia, orbit_sig0, bands="MPLIA")
+    items_plia = static_searches["SENTINEL1_MPLIA"].result()
+    plia_dc = preprocess_static(items_plia, bbox, orbit_sig0, BANDS_PLIA)
     print("projected local incidence angle processed")
 
     return sig0_dc, hpar_dc, plia_dc
+
+
+def preprocess_sig0(items_sig0, bbox):
+    """Sigma naught datacube of items and the orbit of every time step."""
+    sig0_dc = prepare_dc(items_sig0, bbox, bands=BANDS_SIG0)
+    sig0_dc = apply_reference_mask(sig0_dc)
+    return process_sig0_dc(sig0_dc, items_sig0, bands=BANDS_SIG0)
+
+
+def preprocess_static(items, bbox, orbit_sig0, bands):
+    """Static datacube along orbit of the items of the orbits in ``orbit_sig0``."""
+    items = filter_items_by_orbit(items, orbit_sig0)
+    datacube = prepare_dc(items, bbox, bands=bands)
+    return process_datacube(datacube, items, orbit_sig0, bands)
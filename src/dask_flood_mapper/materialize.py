@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+
+from dask.distributed import futures_of, wait
+
+from dask_flood_mapper.catalog import config
+
+STRATEGIES = ("lazy", "checkpoints", "persist")
+STAGES = ("sig0", "static", "flood_dc", "speckles")
+
+
+def materialize(dc, stage):
+    """Persist an intermediate datacube depending on the configured strategy.
+
+    With "persist" every stage is persisted, with "checkpoints" only the stages
+    listed in the configuration and with "lazy" none, so that the pipeline
+    stays one graph from loading to reprojection. Only blocks on the result
+    when it lives on a distributed cluster; with the threaded or synchronous
+    scheduler ``persist`` already returns in-memory data.
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage {stage}, choose from {', '.join(STAGES)}")
+    strategy = config["materialize"]["strategy"]
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown strategy {strategy}, choose from {', '.join(STRATEGIES)}"
+        )
+    if strategy == "lazy":
+        return dc
+    if strategy == "checkpoints" and stage not in config["materialize"]["checkpoints"]:
+        return dc
+
+    dc = dc.persist()
+    futures = futures_of(dc)
+    if futures:
+        wait(futures)
+    return dc
+
+
+@contextmanager
+def materialize_strategy(strategy, checkpoints=None):
+    """Temporarily override the materialization strategy of the configuration.
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>> from dask_flood_mapper.materialize import materialize_strategy
+    >>>
+    >>>
+    >>> with materialize_strategy("lazy"):
+    ...     fd = flood.decision(bbox=bbox, datetime=time_range)
+    >>> fd.compute(scheduler="threads")
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown strategy {strategy}, choose from {', '.join(STRATEGIES)}"
+        )
+    previous = dict(config["materialize"])
+    config["materialize"]["strategy"] = strategy
+    if checkpoints is not None:
+        config["materialize"]["checkpoints"] = list(checkpoints)
+    try:
+        yield
+    finally:
+        config["materialize"].update(previous)
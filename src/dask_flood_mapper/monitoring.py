@@ -0,0 +1,224 @@
+import datetime as dt
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from appdirs import user_data_dir
+
+from dask_flood_mapper import flood
+from dask_flood_mapper.catalog import (
+    SIG0_COLLECTION,
+    config,
+    format_datetime,
+    search_interval,
+    search_items,
+    submit_search,
+)
+from dask_flood_mapper.processing import BANDS_HPAR, BANDS_PLIA
+from dask_flood_mapper.writers import to_zarr, with_fill_value_encoding, zarr
+
+# group of the static layer cache and bands of every static collection
+STATIC_LAYERS = {
+    "SENTINEL1_HPAR": ("hpar", BANDS_HPAR),
+    "SENTINEL1_MPLIA": ("plia", BANDS_PLIA),
+}
+
+
+def monitor(name, bbox, start, outputs=("decision",), store=None):
+    """Classify the acquisitions over an area that are new since the last run.
+
+    The state of the area ``name`` is kept in a directory below
+    ``monitoring: directory``: the last processed acquisition, the recently
+    processed items, the output store and the static layers of every orbit
+    seen so far. The first run classifies everything from ``start`` on.
+    Later runs search sigma naught items from ``monitoring: lookback`` days
+    before the last processed acquisition on, load the static layers of
+    orbits that were not seen before and append the new time steps to the
+    store. Items published late for an acquisition that was already
+    processed, e.g. a second Equi7 tile, are classified together with the
+    other items of the acquisition, whose time step is rewritten in place.
+
+    Parameters
+    ----------
+    name : string
+        Name of the monitored area, also the name of its state directory
+    bbox : tuple of float or tuple of int
+        Geographic bounding box, see ``flood.decision``
+    start : string
+        Datetime string of the first acquisitions of the first run
+    outputs : tuple of string
+        Layers to write, see ``flood.classify``, except the summaries over
+        time
+    store : string or pathlib.Path
+        Zarr store of the flood layers, ``flood.zarr`` in the state directory
+        by default
+
+    Returns
+    -------
+        new flood layers : xarray.Dataset of the time steps appended to or
+        rewritten in the store, None if there were no new items
+
+    Examples
+    --------
+    >>> from dask_flood_mapper.monitoring import monitor
+    >>>
+    >>>
+    >>> bbox = [12.3, 54.3, 13.1, 54.6]
+    >>> monitor("greifswald", bbox, "2022-10-11")
+    """
+    if zarr is None:
+        raise ImportError("Monitoring requires zarr, install dask_flood_mapper[zarr]")
+    flood.check_time_series_outputs(outputs)
+    area = MonitoredArea(name, bbox, start, outputs, store)
+    items_sig0 = area.new_items()
+    if len(items_sig0) == 0:
+        return None
+
+    sig0_dc, orbit_sig0 = flood.preprocess_sig0(items_sig0, bbox)
+    hpar_dc, plia_dc = area.static_layers(orbit_sig0)
+    layers = flood.flood_layers(sig0_dc, hpar_dc, plia_dc, bbox, outputs)
+    if layers.sizes["time"] > 0:
+        to_zarr(layers, area.store, append=True, replace=True)
+    area.processed(items_sig0)
+    if layers.sizes["time"] == 0:
+        return None
+    written = xr.open_zarr(area.store, decode_coords="all")
+    return written.sel(time=layers.time.values)
+
+
+class MonitoredArea:
+    """State of a monitored area, kept as JSON next to its static layers."""
+
+    def __init__(self, name, bbox, start, outputs, store=None):
+        directory = config["monitoring"]["directory"] or Path(
+            user_data_dir("dask_flood_mapper"), "monitoring"
+        )
+        self.directory = Path(directory) / name
+        self.bbox = list(bbox)
+        self.start = start
+        self.state = self.load()
+        run = {"bbox": self.bbox, "outputs": list(outputs)}
+        if self.state is None:
+            store = store or self.directory / "flood.zarr"
+            self.state = {**run, "store": str(store), "last": None, "items": {}}
+        elif {key: self.state[key] for key in run} != run:
+            raise ValueError(
+                f"{name} is monitored with {self.state['bbox']} and "
+                f"{self.state['outputs']}, choose another name"
+            )
+        elif store is not None and str(store) != self.state["store"]:
+            raise ValueError(f"{name} is written to {self.state['store']}")
+        self.store = self.state["store"]
+        self.state.setdefault("items", {})
+
+    def load(self):
+        path = self.directory / "state.json"
+        if not path.exists():
+            return None
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so that an interrupted run keeps
+        # the previous state
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            json.dump(self.state, file)
+        os.replace(file.name, self.directory / "state.json")
+
+    def new_items(self):
+        """Sigma naught items of the acquisitions with unprocessed items.
+
+        Besides the unprocessed items, already processed items of the same
+        acquisitions are returned as well, so that their time steps are
+        classified from all of their tiles.
+        """
+        now = format_datetime(dt.datetime.now(dt.timezone.utc))
+        if self.state["last"] is None:
+            start = search_interval(self.start)[0]
+        else:
+            lookback = dt.timedelta(days=config["monitoring"]["lookback"])
+            start = dt.datetime.fromisoformat(self.state["last"]) - lookback
+        items = search_items(
+            SIG0_COLLECTION, self.bbox, f"{format_datetime(start)}/{now}"
+        )
+        times = {item.datetime for item in items if item.id not in self.state["items"]}
+        return [item for item in items if item.datetime in times]
+
+    def processed(self, items):
+        """Record ``items`` as processed and the last of them as last acquisition.
+
+        Only items within the lookback window of the last acquisition are
+        kept, older ones are not searched again.
+        """
+        last = max(item.datetime for item in items)
+        if self.state["last"] is not None:
+            last = max(last, dt.datetime.fromisoformat(self.state["last"]))
+        self.state["last"] = last.isoformat()
+        processed = {
+            **self.state["items"],
+            **{item.id: item.datetime.isoformat() for item in items},
+        }
+        oldest = last - dt.timedelta(days=config["monitoring"]["lookback"])
+        self.state["items"] = {
+            item_id: acquired
+            for item_id, acquired in processed.items()
+            if dt.datetime.fromisoformat(acquired) >= oldest
+        }
+        self.save()
+
+    def static_layers(self, orbit_sig0):
+        """Harmonic parameters and incidence angles of the orbits in ``orbit_sig0``.
+
+        Orbits that were not seen before are searched, loaded and added to
+        the cached static layers of the area, all others are read from there.
+        """
+        path = self.directory / "static.zarr"
+        orbits = np.unique(orbit_sig0)
+        # the orbits are read from the groups themselves, so a run interrupted
+        # between the groups only loads the ones that are still missing
+        cached = {
+            group: cached_orbits(path, group) for group, _ in STATIC_LAYERS.values()
+        }
+        missing = {
+            collection: orbits[~np.isin(orbits, cached[group])]
+            for collection, (group, _) in STATIC_LAYERS.items()
+        }
+        searches = {
+            collection: submit_search(collection, self.bbox, orbits=missing_orbits)
+            for collection, missing_orbits in missing.items()
+            if missing_orbits.size > 0
+        }
+        for collection, search in searches.items():
+            group, bands = STATIC_LAYERS[collection]
+            datacube = flood.preprocess_static(
+                search.result(), self.bbox, missing[collection], bands
+            )
+            # variable-length names, so that later orbits such as "A117" can
+            # be appended to a store started with "A15"
+            datacube = datacube.assign_coords(orbit=datacube.orbit.astype(object))
+            datacube = with_fill_value_encoding(datacube)
+            if len(cached[group]) > 0:
+                datacube.to_zarr(path, group=group, append_dim="orbit")
+            else:
+                datacube.to_zarr(path, group=group, mode="w")
+        return tuple(
+            xr.open_zarr(path, group=group, decode_coords="all")
+            .sel(orbit=orbits)
+            .assign_coords(orbit=orbits)
+            for group, _ in STATIC_LAYERS.values()
+        )
+
+
+def cached_orbits(path, group):
+    """Orbits of the static layers in ``group`` of the store at ``path``."""
+    try:
+        with xr.open_zarr(path, group=group) as cached:
+            return np.array(cached.orbit.values.tolist(), dtype=str)
+    except (FileNotFoundError, KeyError):
+        return np.array([], dtype=str)
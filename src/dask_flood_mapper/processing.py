@@ -1,15 +1,20 @@
 import xarray as xr
 import numpy as np
+import dask.array as da
 from odc import stac as odc_stac
 import rioxarray  # noqa
-from dask.distributed import wait
+from dask_flood_mapper.calculation import flood_validity_mask
 from dask_flood_mapper.catalog import config
+from dask_flood_mapper.materialize import materialize
+from dask_flood_mapper.reprojection import reproject_chunked
+from dask_flood_mapper.tile_cache import tile_cache
 
 
 # import parameters from config.yaml file
 crs = config["base"]["crs"]
 chunks = config["base"]["chunks"]
 groupby = config["base"]["groupby"]
+precision = config["base"]["precision"]
 BANDS_HPAR = (
     "C1",
     "C2",
@@ -44,35 +49,100 @@ def process_sig0_dc(sig0_dc, items_sig0, bands):
         .sortby("time")
     )
 
-    __, indices = np.unique(sig0_dc.time, return_index=True)
-    indices.sort()
+    # acquisitions split over several tiles share a time stamp, the orbit of
+    # the first one is kept
+    sig0_dc = mosaic(sig0_dc, "time")
 
-    orbit_sig0 = sig0_dc.orbit[indices].data
+    orbit_sig0 = sig0_dc.orbit.data
 
-    sig0_dc = sig0_dc.groupby("time").mean(skipna=True)
-
-    sig0_dc = sig0_dc.assign_coords(orbit=("time", orbit_sig0))
-
-    sig0_dc = sig0_dc.persist()
-    wait(sig0_dc)
+    sig0_dc = materialize(sig0_dc, "sig0")
 
     return sig0_dc, orbit_sig0
 
 
 def process_datacube(datacube, items_dc, orbit_sig0, bands):
-    datacube = post_process_eodc_cube(datacube, items_dc, bands).rename(
-        {"time": "orbit"}
-    )
+    cache = tile_cache()
+    cached_dc = None
+    if cache is not None:
+        cached_dc = cache.load(
+            items_dc,
+            datacube.odc.geobox,
+            bands,
+            decode=post_process_eodc_cube,
+            dtype=precision,
+        )
+    if cached_dc is None:
+        datacube = post_process_eodc_cube(datacube, items_dc, bands)
+    else:
+        datacube = cached_dc.chunk(datacube.chunksizes)
+    datacube = datacube.rename({"time": "orbit"})
 
     datacube["orbit"] = extract_orbit_names(items_dc)
 
-    datacube = datacube.groupby("orbit").mean(skipna=True)
+    datacube = mosaic(datacube, "orbit")
+
+    datacube = datacube.sel(orbit=np.unique(orbit_sig0))
 
-    datacube = datacube.sel(orbit=orbit_sig0)
+    return materialize(datacube, "static")
 
-    datacube = datacube.persist()
-    wait(datacube)
-    return datacube
+
+def mosaic(dc, dim):
+    """Mean of the entries of ``dc`` with the same label along ``dim``.
+
+    Equivalent to ``dc.groupby(dim).mean(skipna=True)``, but the entries are
+    sorted so that duplicates are adjacent, the chunks along ``dim`` are
+    aligned with the groups and every chunk is averaged on its own in one
+    blockwise pass. Other coordinates along ``dim`` keep the value of the
+    first entry of each group.
+    """
+    order = np.argsort(dc[dim].values, kind="stable")
+    if (order != np.arange(order.size)).any():
+        dc = dc.isel({dim: order})
+    __, starts, counts = np.unique(
+        dc[dim].values, return_index=True, return_counts=True
+    )
+    if (counts == 1).all():
+        return dc
+
+    mosaicked = dc.isel({dim: starts})
+    for name, variable in dc.data_vars.items():
+        if dim not in variable.dims:
+            continue
+        axis = variable.get_axis_num(dim)
+        data = variable.data
+        dtype = mean_dtype(data.dtype)
+        if isinstance(data, da.Array):
+            data = data.rechunk({axis: tuple(counts)})
+            chunks = list(data.chunks)
+            chunks[axis] = (1,) * counts.size
+            data = data.map_blocks(
+                group_mean, starts=[0], axis=axis, chunks=chunks, dtype=dtype
+            )
+        else:
+            data = group_mean(data, starts, axis)
+        mosaicked[name] = mosaicked[name].copy(data=data)
+    return mosaicked
+
+
+def group_mean(data, starts, axis):
+    """NaN-skipping mean of the consecutive groups beginning at ``starts``."""
+    valid = ~np.isnan(data)
+    total = np.add.reduceat(
+        np.where(valid, data, 0), starts, axis=axis, dtype=mean_dtype(data.dtype)
+    )
+    count = np.add.reduceat(valid, starts, axis=axis, dtype=np.int32)
+    with np.errstate(invalid="ignore"):
+        return np.divide(total, count, out=total)
+
+
+def mean_dtype(dtype):
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+
+def filter_items_by_orbit(items, orbit_sig0):
+    """Keep only the items of orbits that occur in the sigma naught datacube."""
+    keep = np.isin(extract_orbit_names(items), orbit_sig0)
+    return [item for item, is_used in zip(items, keep) if is_used]
 
 
 # post-processing
@@ -87,8 +157,9 @@ def post_process_eodc_cube(dc: xr.Dataset, items, bands):
 def post_process_eodc_cube_(dc: xr.DataArray, items, band):
     scale = items[0].assets[band].extra_fields.get("raster:bands")[0]["scale"]
     nodata = items[0].assets[band].extra_fields.get("raster:bands")[0]["nodata"]
-    # Apply the scaling and nodata masking logic
-    return dc.where(dc != nodata) / scale
+    dtype = np.dtype(precision)
+    # Apply the scaling and nodata masking logic in the configured precision
+    return dc.astype(dtype).where(dc != nodata) / dtype.type(scale)
 
 
 def extract_orbit_names(items):
@@ -102,18 +173,16 @@ def extract_orbit_names(items):
 
 
 def post_processing(dc):
-    dc = dc * np.logical_and(dc.MPLIA >= 27, dc.MPLIA <= 48)
-    dc = dc * (dc.hbsc > (dc.wbsc + 0.5 * 2.754041))
-    land_bsc_lower = dc.hbsc - 3 * dc.STD
-    land_bsc_upper = dc.hbsc + 3 * dc.STD
-    water_bsc_upper = dc.wbsc + 3 * 2.754041
-    mask_land_outliers = np.logical_and(
-        dc.sig0 > land_bsc_lower, dc.sig0 < land_bsc_upper
+    """Decision of the pixels that pass the filters of ``flood_validity_mask``.
+
+    The mask is built once from the layers it needs and only applied to the
+    decision, other variables of ``dc`` are not touched.
+    """
+    mask = flood_validity_mask(
+        dc.sig0, dc.MPLIA, dc.STD, dc.wbsc, dc.hbsc, dc.f_post_prob
     )
-    mask_water_outliers = dc.sig0 < water_bsc_upper
-    dc = dc * (mask_land_outliers | mask_water_outliers)
-    return (dc * (dc.f_post_prob > 0.8)).decision
+    return (dc.decision * mask).rename("decision")
 
 
-def reproject_equi7grid(dc, bbox, target_epsg="EPSG:4326"):
-    return dc.rio.reproject(target_epsg).rio.clip_box(*bbox)
+def reproject_equi7grid(dc, bbox, target_epsg="EPSG:4326", grid=None):
+    return reproject_chunked(dc, bbox, target_epsg, grid=grid)
@@ -0,0 +1,85 @@
+from functools import lru_cache
+from importlib.resources import files
+
+import numpy as np
+import rasterio
+import xarray as xr
+from rasterio import warp
+
+from dask_flood_mapper.catalog import config
+
+REFERENCE_FILE = files("dask_flood_mapper.data").joinpath("wcover.tif")
+WORLDCOVER_CLASSES = np.array([10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100])
+
+
+def apply_reference_mask(dc):
+    """Set pixels of permanent water and excluded land cover to no data.
+
+    Does nothing unless ``reference: enabled`` is set in the configuration.
+    Masked pixels are missing from then on, so they are never classified,
+    filtered or warped and are no data in all flood layers. Bands keep their
+    data type and take their ``nodata`` value, as loaded by ``odc.stac``;
+    integer bands without one become floating point with NaN.
+    """
+    reference_config = config["reference"]
+    if not reference_config["enabled"]:
+        return dc
+    mask = reference_mask(
+        dc.odc.geobox,
+        str(reference_config["path"] or REFERENCE_FILE),
+        tuple(reference_config["water"]) + tuple(reference_config["exclude"]),
+    )
+    dims = dc.odc.spatial_dims
+    mask = xr.DataArray(mask, coords={dim: dc[dim] for dim in dims})
+    if dc.chunks:
+        mask = mask.chunk({dim: dc.chunksizes[dim] for dim in dims})
+
+    def mask_band(band):
+        if not set(dims) <= set(band.dims):
+            return band
+        nodata = band.odc.nodata
+        if nodata is None:
+            return band.where(mask)
+        return band.where(mask, band.dtype.type(nodata))
+
+    return dc.map(mask_band, keep_attrs=True)
+
+
+@lru_cache(maxsize=16)
+def reference_mask(geobox, path, classes):
+    """Boolean array on ``geobox`` of the pixels to classify.
+
+    The land cover map at ``path`` is resampled to the grid once with nearest
+    neighbours; pixels of one of ``classes`` are False. Pixels outside the map
+    or without a land cover are kept.
+
+    The bundled map was resampled from ESA WorldCover with interpolation and
+    also holds values between two classes, e.g. 81 to 89 at the edges of
+    permanent water. Every value is therefore assigned to the nearest
+    WorldCover class first, ties to the lower one, so 81 to 85 count as
+    water. Maps holding only WorldCover classes are not changed by this.
+    """
+    with rasterio.open(path) as src:
+        nodata = 0 if src.nodata is None else src.nodata
+        landcover = np.full(geobox.shape, nodata, dtype=src.dtypes[0])
+        warp.reproject(
+            rasterio.band(src, 1),
+            landcover,
+            src_nodata=nodata,
+            dst_transform=geobox.transform,
+            dst_crs=geobox.crs.wkt,
+            dst_nodata=nodata,
+            resampling=warp.Resampling.nearest,
+        )
+    landcover = np.where(landcover == nodata, nodata, nearest_class(landcover))
+    return ~np.isin(landcover, classes)
+
+
+def nearest_class(landcover):
+    """Nearest WorldCover class of every value, the lower one on ties."""
+    upper = np.searchsorted(WORLDCOVER_CLASSES, landcover)
+    upper = np.clip(upper, 1, len(WORLDCOVER_CLASSES) - 1)
+    lower_class, upper_class = WORLDCOVER_CLASSES[upper - 1], WORLDCOVER_CLASSES[upper]
+    return np.where(
+        landcover - lower_class <= upper_class - landcover, lower_class, upper_class
+    )
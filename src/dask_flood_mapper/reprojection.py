@@ -0,0 +1,399 @@
+import hashlib
+import math
+import os
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+from appdirs import user_cache_dir
+from rasterio import warp
+from rasterio.crs import CRS
+from rasterio.transform import array_bounds
+from rasterio.windows import from_bounds
+from rioxarray.rioxarray import affine_to_coords
+
+from dask_flood_mapper.catalog import config
+from dask_flood_mapper.skipping import count_skipped, is_missing
+
+
+def reproject_chunked(dc, bbox, target_epsg="EPSG:4326", tile_size=None, grid=None):
+    """Reproject the y and x dimensions of ``dc`` to ``target_epsg`` within ``bbox``.
+
+    The target grid is the one of ``dc.rio.reproject(target_epsg)`` cut to
+    ``bbox`` like ``rio.clip_box``, but only the cut grid is resampled. It is
+    split into tiles of ``tile_size`` pixels, by default the spatial chunk
+    size of ``dc``. Every tile is warped from the source blocks it overlaps,
+    so Dask-backed data stays lazy and the tiles are computed in parallel.
+
+    Pixels take the value of the source pixel containing their centre, up to
+    the interpolation of ``cache: reprojection: step``, see ``pixel_index``.
+    Unlike the warp of ``rio.reproject``, whose approximation of the
+    coordinate transform depends on the extent being warped, the result does
+    not depend on the tiling. A ``grid`` of transform and shape replaces
+    the default target grid, e.g. to warp one part of a larger grid.
+    """
+    src_crs = dc.rio.crs
+    src_transform = dc.rio.transform(recalc=True)
+    if grid is None:
+        grid = target_grid(src_crs, src_transform, dc.rio.shape, bbox, target_epsg)
+    transform, shape = grid
+
+    def reproject_array(array):
+        nodata = src_nodata = array.rio.nodata
+        if nodata is None:
+            nodata = np.nan if np.issubdtype(array.dtype, np.floating) else 0
+        dims = [dim for dim in array.dims if dim not in ("y", "x")] + ["y", "x"]
+        array = array.transpose(*dims)
+        kwargs = {
+            "src_crs": src_crs,
+            "src_transform": src_transform,
+            "dst_crs": target_epsg,
+            "src_nodata": src_nodata,
+            "nodata": nodata,
+        }
+        if isinstance(array.data, da.Array):
+            size = tile_size or max(array.chunks[-2][0], array.chunks[-1][0])
+            data = warp_tiles(array.data, transform, shape, size, **kwargs)
+        else:
+            window = (slice(0, shape[0]), slice(0, shape[1]))
+            data = warp_block(
+                array.data,
+                dst_transform=transform,
+                window=window,
+                origin=(0, 0),
+                **kwargs,
+            )
+        coords = {
+            name: coord
+            for name, coord in array.coords.items()
+            if not {"y", "x"} & set(coord.dims) and name != "spatial_ref"
+        }
+        coords.update(affine_to_coords(transform, shape[1], shape[0]))
+        reprojected = xr.DataArray(
+            data, dims=dims, coords=coords, attrs=array.attrs, name=array.name
+        )
+        reprojected.encoding = array.encoding
+        return reprojected.rio.write_nodata(nodata)
+
+    if isinstance(dc, xr.Dataset):
+        reprojected = dc.drop_dims(["y", "x"]).drop_vars("spatial_ref", errors="ignore")
+        reprojected = reprojected.assign(
+            {
+                name: reproject_array(var)
+                for name, var in dc.data_vars.items()
+                if {"y", "x"} <= set(var.dims)
+            }
+        )
+    else:
+        reprojected = reproject_array(dc)
+    reprojected = reprojected.rio.write_crs(target_epsg)
+    reprojected = reprojected.rio.write_transform(transform)
+    return reprojected.rio.write_coordinate_system()
+
+
+def target_grid(src_crs, src_transform, src_shape, bbox, target_epsg):
+    """Transform and shape of the default target grid clipped to ``bbox``.
+
+    Follows ``rio.reproject`` for the resolution and extent of the grid and
+    ``rio.clip_box`` for the pixels kept within ``bbox``.
+    """
+    height, width = src_shape
+    transform, dst_width, dst_height = warp.calculate_default_transform(
+        src_crs,
+        target_epsg,
+        width,
+        height,
+        *array_bounds(height, width, src_transform),
+    )
+    (row_start, row_stop), (col_start, col_stop) = from_bounds(
+        *bbox, transform=transform
+    ).toranges()
+    rows = slice(
+        min(max(math.floor(row_start), 0), dst_height),
+        min(max(math.ceil(row_stop), 0), dst_height),
+    )
+    cols = slice(
+        min(max(math.floor(col_start), 0), dst_width),
+        min(max(math.ceil(col_stop), 0), dst_width),
+    )
+    if rows.start == rows.stop or cols.start == cols.stop:
+        raise ValueError(f"No data found within the bounding box {bbox}")
+    transform = transform * transform.translation(cols.start, rows.start)
+    return transform, (rows.stop - rows.start, cols.stop - cols.start)
+
+
+def warp_tiles(data, transform, shape, tile_size, **kwargs):
+    """Assemble the target grid from tiles warped from overlapping source blocks."""
+    tiles = []
+    for row in range(0, shape[0], tile_size):
+        tiles.append([])
+        for col in range(0, shape[1], tile_size):
+            window = (
+                slice(row, min(row + tile_size, shape[0])),
+                slice(col, min(col + tile_size, shape[1])),
+            )
+            tiles[-1].append(warp_tile(data, transform, window, **kwargs))
+    return da.block(tiles)
+
+
+def warp_tile(
+    data, transform, window, src_crs, src_transform, dst_crs, src_nodata, nodata
+):
+    """Warp one target tile from the source pixels that can fall within it."""
+    rows, cols = source_window(
+        data.shape[-2:], src_crs, src_transform, dst_crs, transform, window
+    )
+    leading = data.chunks[:-2]
+    shape = tuple(index.stop - index.start for index in window)
+    chunks = leading + tuple((size,) for size in shape)
+    if rows.start == rows.stop or cols.start == cols.stop:
+        return da.full(data.shape[:-2] + shape, nodata, dtype=data.dtype, chunks=chunks)
+    source = data[..., rows, cols].rechunk(leading + (-1, -1))
+    return source.map_blocks(
+        warp_block,
+        src_crs=src_crs,
+        src_transform=src_transform,
+        dst_crs=dst_crs,
+        dst_transform=transform,
+        window=window,
+        origin=(rows.start, cols.start),
+        src_nodata=src_nodata,
+        nodata=nodata,
+        chunks=chunks,
+        meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+    )
+
+
+def source_window(src_shape, src_crs, src_transform, dst_crs, transform, window):
+    """Source rows and columns covering a target tile, with a margin of two pixels."""
+    rows, cols = window
+    tile_transform = transform * transform.translation(cols.start, rows.start)
+    bounds = warp.transform_bounds(
+        dst_crs,
+        src_crs,
+        *array_bounds(rows.stop - rows.start, cols.stop - cols.start, tile_transform),
+        densify_pts=21,
+    )
+    (row_start, row_stop), (col_start, col_stop) = from_bounds(
+        *bounds, transform=src_transform
+    ).toranges()
+    return (
+        slice(
+            min(max(math.floor(row_start) - 2, 0), src_shape[0]),
+            min(max(math.ceil(row_stop) + 2, 0), src_shape[0]),
+        ),
+        slice(
+            min(max(math.floor(col_start) - 2, 0), src_shape[1]),
+            min(max(math.ceil(col_stop) + 2, 0), src_shape[1]),
+        ),
+    )
+
+
+def warp_block(
+    block,
+    src_crs,
+    src_transform,
+    dst_crs,
+    dst_transform,
+    window,
+    origin,
+    src_nodata,
+    nodata,
+):
+    """Nearest neighbour warp of a numpy array over its last two axes.
+
+    ``block`` holds the source pixels from ``origin`` on and is warped to the
+    ``window`` of the target grid. Blocks without any valid source pixel are
+    not warped but replaced by ``nodata``.
+    """
+    missing = is_missing(block, nodata)
+    if src_nodata is not None:
+        missing |= is_missing(block, src_nodata)
+    if missing.all():
+        count_skipped("reproject")
+        shape = tuple(index.stop - index.start for index in window)
+        return np.full(block.shape[:-2] + shape, nodata, dtype=block.dtype)
+
+    rows, cols = index_cache().index(
+        src_crs, src_transform, dst_crs, dst_transform, window
+    )
+    rows = rows - origin[0]
+    cols = cols - origin[1]
+    valid = (
+        (rows >= 0) & (rows < block.shape[-2]) & (cols >= 0) & (cols < block.shape[-1])
+    )
+    warped = np.full(block.shape[:-2] + rows.shape, nodata, dtype=block.dtype)
+    warped[..., valid] = block[..., rows[valid], cols[valid]]
+    if src_nodata is not None and not np.array_equal(src_nodata, nodata):
+        warped[warped == src_nodata] = nodata
+    return warped
+
+
+def pixel_index(src_crs, src_transform, dst_crs, dst_transform, window, step=16):
+    """Source pixel of every target pixel centre within ``window``.
+
+    The centres are transformed on a lattice of every ``step``-th pixel of
+    the target grid and interpolated bilinearly in between, about 20 times
+    faster than transforming every centre. This is approximate: for the
+    Equi7 projections and a step of 16, about one pixel in 13,000, whose
+    centre lies within a ten-thousandth of a pixel of a source pixel edge,
+    takes the neighbouring source pixel. ``step=1`` transforms every centre
+    exactly. As the lattice is tied to the target grid and not to the
+    window, the index of a pixel does not depend on the tiling either way.
+    """
+    if step == 1:
+        rows, cols = (np.arange(index.start, index.stop) for index in window)
+        x, y = dst_transform * np.meshgrid(cols + 0.5, rows + 0.5)
+        x, y = warp.transform(dst_crs, src_crs, x.ravel(), y.ravel())
+        src_cols, src_rows = ~src_transform * (np.asarray(x), np.asarray(y))
+        shape = (len(rows), len(cols))
+        return (
+            np.floor(src_rows).astype(np.int32).reshape(shape),
+            np.floor(src_cols).astype(np.int32).reshape(shape),
+        )
+
+    lattice, weights = [], []
+    for index in window:
+        start = index.start // step * step
+        n_nodes = (index.stop - 1 - start) // step + 2
+        lattice.append(start + step * np.arange(n_nodes))
+        offset = np.arange(index.start, index.stop) - start
+        weights.append((offset // step, offset % step / step))
+    x, y = dst_transform * np.meshgrid(lattice[1] + 0.5, lattice[0] + 0.5)
+    x, y = warp.transform(dst_crs, src_crs, x.ravel(), y.ravel())
+    src_cols, src_rows = ~src_transform * (np.asarray(x), np.asarray(y))
+
+    (row_nodes, row_weights), (col_nodes, col_weights) = weights
+    row_weights = row_weights[:, np.newaxis]
+
+    def interpolate(values):
+        values = values.reshape(len(lattice[0]), len(lattice[1]))
+        top, bottom = values[row_nodes], values[row_nodes + 1]
+        top = (
+            top[:, col_nodes] * (1 - col_weights) + top[:, col_nodes + 1] * col_weights
+        )
+        bottom = (
+            bottom[:, col_nodes] * (1 - col_weights)
+            + bottom[:, col_nodes + 1] * col_weights
+        )
+        return np.floor(top * (1 - row_weights) + bottom * row_weights).astype(np.int32)
+
+    return interpolate(src_rows), interpolate(src_cols)
+
+
+@lru_cache
+def index_cache():
+    cache_config = config["cache"]
+    directory = cache_config["directory"] or user_cache_dir("dask_flood_mapper")
+    return IndexCache(Path(directory) / "reprojection", **cache_config["reprojection"])
+
+
+class IndexCache:
+    """Source pixel indices of target tiles, see ``pixel_index``.
+
+    The indices only depend on the source grid and the target tile, so they
+    are shared by all time steps and by repeated requests for the same bbox.
+    They are computed with the lattice ``step`` of ``pixel_index`` and kept
+    in memory up to ``memory_size`` megabytes per process and, with
+    ``disk=True``, stored as ``.npy`` files evicted by least recent use
+    beyond ``max_size`` megabytes. The cache is shared by the threads of a
+    worker, so the entries in memory are only accessed under a lock.
+    """
+
+    def __init__(self, directory, memory_size=256, disk=False, max_size=1000, step=16):
+        self.directory = Path(directory)
+        self.memory_size = memory_size * 1e6
+        self.disk = disk
+        self.max_size = max_size * 1e6
+        self.step = step
+        self.entries = OrderedDict()
+        self._lock = Lock()
+
+    def key(self, src_crs, src_transform, dst_crs, dst_transform, window):
+        grids = repr(
+            (
+                CRS.from_user_input(src_crs).to_wkt(),
+                tuple(src_transform),
+                CRS.from_user_input(dst_crs).to_wkt(),
+                tuple(dst_transform),
+                [(index.start, index.stop) for index in window],
+                self.step,
+            )
+        )
+        return hashlib.sha256(grids.encode()).hexdigest()[:32]
+
+    def index(self, src_crs, src_transform, dst_crs, dst_transform, window):
+        key = self.key(src_crs, src_transform, dst_crs, dst_transform, window)
+        index = self.get(key)
+        if index is None:
+            index = np.stack(
+                pixel_index(
+                    src_crs, src_transform, dst_crs, dst_transform, window, self.step
+                )
+            )
+            self.put(key, index)
+        return index[0], index[1]
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        path = self.directory / f"{key}.npy"
+        if not self.disk or not path.exists():
+            return None
+        try:
+            index = np.load(path)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        self._remember(key, index)
+        return index
+
+    def put(self, key, index):
+        self._remember(key, index)
+        if not self.disk:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so readers never see partial entries
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            np.save(file, index)
+        os.replace(file.name, self.directory / f"{key}.npy")
+        self.evict()
+
+    def _remember(self, key, index):
+        with self._lock:
+            self.entries[key] = index
+            self.entries.move_to_end(key)
+            size = sum(entry.nbytes for entry in self.entries.values())
+            while size > self.memory_size and len(self.entries) > 1:
+                size -= self.entries.popitem(last=False)[1].nbytes
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by a concurrent thread
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            size -= entry_size
+            path.unlink(missing_ok=True)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+        for path in self.directory.glob("*.npy"):
+            path.unlink(missing_ok=True)
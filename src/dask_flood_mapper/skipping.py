@@ -0,0 +1,57 @@
+from collections import Counter
+from threading import Lock
+
+import numpy as np
+
+STAGES = ("classify", "mask", "median_filter", "reproject")
+
+_skipped = Counter()
+_lock = Lock()
+
+
+def count_skipped(stage):
+    """Record that the computation of one block was skipped at ``stage``."""
+    with _lock:
+        _skipped[stage] += 1
+
+
+def skipped_chunks(client=None):
+    """Number of skipped blocks per stage since the last reset.
+
+    Blocks are counted in the process that computes them. With a distributed
+    ``client`` the counts of all its workers are added to those of this
+    process.
+
+    Examples
+    --------
+    >>> from dask_flood_mapper import flood
+    >>> from dask_flood_mapper.skipping import skipped_chunks
+    >>>
+    >>>
+    >>> fd = flood.decision(bbox=bbox, datetime=time_range).compute()
+    >>> skipped_chunks(client)
+    {'classify': 12, 'mask': 3, 'median_filter': 15, 'reproject': 4}
+    """
+    with _lock:
+        counts = Counter(_skipped)
+    if client is not None:
+        for worker_counts in client.run(skipped_chunks).values():
+            counts.update(worker_counts)
+    return {stage: counts[stage] for stage in STAGES}
+
+
+def reset_skipped_chunks(client=None):
+    """Set the counters of this process, and of the workers of ``client``, to 0."""
+    with _lock:
+        _skipped.clear()
+    if client is not None:
+        client.run(reset_skipped_chunks)
+
+
+def is_missing(block, nodata):
+    """Boolean array of the pixels of ``block`` that equal ``nodata``."""
+    if nodata is None:
+        return np.zeros(block.shape, dtype=bool)
+    if np.isnan(nodata):
+        return np.isnan(block)
+    return block == nodata
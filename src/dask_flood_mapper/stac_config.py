@@ -35,4 +35,17 @@ def set_user_config(user_config_dir=USER_CONFIG_DIR):
 def load_config(user_config_dir=USER_CONFIG_DIR):
     yaml_file = set_user_config(user_config_dir)
     with open(yaml_file, "r") as file:
-        return yaml.safe_load(file)
+        user_config = yaml.safe_load(file)
+    with open(CONFIG_PATH, "r") as file:
+        default_config = yaml.safe_load(file)
+    return merge_config(default_config, user_config)
+
+
+def merge_config(default_config, user_config):
+    """Fill settings missing from an older user configuration with defaults."""
+    merged = dict(default_config)
+    for key, value in user_config.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_config(merged[key], value)
+        merged[key] = value
+    return merged
@@ -0,0 +1,234 @@
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+from appdirs import user_cache_dir
+from odc import stac as odc_stac
+from odc.geo.xr import xr_coords
+
+from dask_flood_mapper.catalog import config
+
+try:
+    import zarr
+except ImportError:  # optional dependency, install with dask_flood_mapper[zarr]
+    zarr = None
+
+
+@lru_cache
+def tile_cache():
+    """Tile cache of the configuration, or None if it is disabled."""
+    cache_config = config["cache"]
+    static_config = dict(cache_config["static"])
+    if not static_config.pop("enabled") or zarr is None:
+        return None
+    directory = cache_config["directory"] or user_cache_dir("dask_flood_mapper")
+    return TileCache(Path(directory) / "static", **static_config)
+
+
+class TileCache:
+    """Local Zarr store of decoded static layers per Equi7 tile and orbit.
+
+    Every STAC item of the harmonic parameters and incidence angles covers one
+    Equi7 tile of one orbit. Its bands are kept decoded, in the data type the
+    caller decodes to, on the native grid of the tile, so cached and remote
+    layers are identical. Blocks of ``block_size`` pixels are fetched from
+    the remote COGs the first time a computation touches them; later
+    requests read them from disk. Least recently used tiles are evicted once
+    the store grows beyond ``max_size`` megabytes.
+
+    The store has to be reachable from the Dask workers, e.g. with a local
+    cluster or a shared file system.
+    """
+
+    def __init__(self, directory, max_size=10_000, block_size=1300):
+        self.directory = Path(directory)
+        self.max_size = max_size * 1e6
+        self.block_size = block_size
+
+    def load(self, items, geobox, bands, decode, dtype="float64"):
+        """Decoded layers of the items on ``geobox``, one time step per item.
+
+        ``decode`` applies the scaling and nodata masking to freshly loaded
+        blocks, see ``processing.post_process_eodc_cube``, and returns them as
+        ``dtype``. Layers of each data type are cached separately. Returns
+        None when a tile is not aligned with ``geobox`` and can therefore not
+        be cached.
+
+        Nothing is fetched or written while the graph is built. Missing blocks
+        are loaded, written to the store and marked as cached when the
+        returned layers are computed, before the tile is read from the store.
+        """
+        if not isinstance(bands, tuple):
+            bands = tuple([bands])
+        tiles = [self._tile_geobox(item, bands) for item in items]
+        offsets = [pixel_offset(tile, geobox) for tile in tiles]
+        if any(offset is None for offset in offsets):
+            return None
+
+        dtype = np.dtype(dtype)
+        layers = {band: [] for band in bands}
+        for item, tile, offset in zip(items, tiles, offsets):
+            rows, cols = overlap(tile.shape, geobox.shape, offset)
+            arrays = self._open_arrays(item, tile, bands, dtype)
+            written = self._fetch(
+                item, tile, arrays, self._missing(arrays, rows, cols), decode
+            )
+            for band in bands:
+                layers[band].append(
+                    read_window(arrays[band], rows, cols, geobox.shape, offset, written)
+                )
+            os.utime(self._item_path(item))
+        self.evict(keep=[self._item_path(item) for item in items])
+
+        coords = xr_coords(geobox)
+        coords["time"] = [np.datetime64(item.datetime, "ns") for item in items]
+        return xr.Dataset(
+            {band: (("time", "y", "x"), da.stack(layers[band])) for band in bands},
+            coords=coords,
+        )
+
+    def _tile_geobox(self, item, bands):
+        parsed = odc_stac.parse_items([item])
+        return odc_stac.output_geobox(list(parsed), bands=list(bands))
+
+    def _item_path(self, item):
+        return self.directory / str(item.collection_id) / item.id
+
+    def _open_arrays(self, item, tile, bands, dtype):
+        path = self._item_path(item) / dtype.name
+        path.mkdir(parents=True, exist_ok=True)
+        return {
+            band: zarr.open_array(
+                store=str(path / band),
+                mode="a",
+                shape=tile.shape,
+                chunks=(self.block_size, self.block_size),
+                dtype=dtype,
+                fill_value=np.nan,
+            )
+            for band in bands
+        }
+
+    def _missing(self, arrays, rows, cols):
+        if rows.start == rows.stop or cols.start == cols.stop:
+            return []
+        size = self.block_size
+        cached = set.intersection(
+            *(
+                {tuple(block) for block in array.attrs.get("blocks", [])}
+                for array in arrays.values()
+            )
+        )
+        return [
+            (i, j)
+            for i in range(rows.start // size, -(-rows.stop // size))
+            for j in range(cols.start // size, -(-cols.stop // size))
+            if (i, j) not in cached
+        ]
+
+    def _fetch(self, item, tile, arrays, blocks, decode):
+        """Delayed write of the missing ``blocks`` of a tile, None without any."""
+        if not blocks:
+            return None
+        bands = tuple(arrays)
+        size = self.block_size
+        sources, targets, regions = [], [], []
+        for i, j in blocks:
+            region = (
+                slice(i * size, min((i + 1) * size, tile.height)),
+                slice(j * size, min((j + 1) * size, tile.width)),
+            )
+            block_dc = odc_stac.load(
+                [item], bands=bands, geobox=tile[region], chunks={}, groupby=None
+            )
+            block_dc = decode(block_dc, [item], bands)
+            for band in bands:
+                sources.append(block_dc[band].data[0].astype(arrays[band].dtype))
+                targets.append(arrays[band])
+                regions.append(region)
+        stored = da.store(sources, targets, regions=regions, lock=False, compute=False)
+        return record_blocks(stored, list(arrays.values()), blocks)
+
+    def evict(self, keep=()):
+        """Remove least recently used tiles until the store fits ``max_size``."""
+        if not self.directory.exists():
+            return
+        tiles = sorted(
+            (path.stat().st_mtime, directory_size(path), path)
+            for collection in self.directory.iterdir()
+            for path in collection.iterdir()
+        )
+        size = sum(tile_size for _, tile_size, _ in tiles)
+        for _, tile_size, path in tiles:
+            if size <= self.max_size:
+                break
+            if path in keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            size -= tile_size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def pixel_offset(tile, geobox):
+    """Pixel offset of ``geobox`` in the grid of ``tile``, None if unaligned."""
+    tile_transform, transform = tile.transform, geobox.transform
+    if (
+        tile.crs != geobox.crs
+        or tile_transform[:2] + tile_transform[3:5] != transform[:2] + transform[3:5]
+    ):
+        return None
+    row = (transform.f - tile_transform.f) / tile_transform.e
+    col = (transform.c - tile_transform.c) / tile_transform.a
+    if not (np.isclose(row, round(row)) and np.isclose(col, round(col))):
+        return None
+    return round(row), round(col)
+
+
+def overlap(tile_shape, shape, offset):
+    """Rows and columns of a tile that fall within a window at ``offset``."""
+    return tuple(
+        slice(min(max(start, 0), size), min(max(start + length, 0), size))
+        for start, length, size in zip(offset, shape, tile_shape)
+    )
+
+
+@dask.delayed
+def record_blocks(stored, arrays, blocks):
+    """Mark ``blocks`` as cached in ``arrays`` once they are ``stored``."""
+    for array in arrays:
+        cached = {tuple(block) for block in array.attrs.get("blocks", [])}
+        array.attrs["blocks"] = sorted(cached | set(blocks))
+
+
+def read_window(array, rows, cols, shape, offset, written=None):
+    """Read part of a cached tile and pad it with NaN to the requested window.
+
+    The blocks are read after the delayed ``written``, if given, is computed.
+    """
+    if rows.start == rows.stop or cols.start == cols.stop:
+        return da.full(shape, np.nan, dtype=array.dtype)
+    window = da.from_zarr(array)[rows, cols]
+    if written is not None:
+        window = window.map_blocks(
+            after_write, written, meta=np.empty((0, 0), dtype=array.dtype)
+        )
+    pad = [
+        (index.start - start, start + length - index.stop)
+        for index, start, length in zip((rows, cols), offset, shape)
+    ]
+    return da.pad(window, pad, constant_values=np.nan)
+
+
+def after_write(block, written):
+    return block
+
+
+def directory_size(path):
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+from odc import stac as odc_stac
+from rasterio.transform import Affine, array_bounds
+from rioxarray.rioxarray import affine_to_coords
+
+from dask_flood_mapper import flood
+from dask_flood_mapper.catalog import SIG0_COLLECTION, config, search_items
+from dask_flood_mapper.reprojection import target_grid
+from dask_flood_mapper.writers import with_fill_value_encoding, zarr, zarr_encoding
+
+TARGET_EPSG = "EPSG:4326"
+
+
+def classify_tiled(bbox, datetime, store, outputs=("decision",)):
+    """Classify a large area tile by tile into one Zarr store.
+
+    The target grid of the whole ``bbox`` is split into tiles of
+    ``tiling: size`` pixels. Every tile is loaded with a margin of
+    ``tiling: halo`` degrees, so that the speckle filter and the warp see
+    the same neighbourhood as for the whole area, classified on its part of
+    the grid and written to its region of the store. At most
+    ``tiling: workers`` tiles are processed at the same time, which bounds
+    the size of the task graphs and the memory in use independently of the
+    area.
+
+    ``outputs`` are the layers of ``flood.classify`` with a time dimension.
+    The finished tiles are recorded in the store. Calling the function again
+    with the same arguments, e.g. after a failure, only processes the tiles
+    that are missing. Returns the store opened with xarray.
+
+    Examples
+    --------
+    >>> from dask_flood_mapper.tiling import classify_tiled
+    >>>
+    >>>
+    >>> bbox = [9.5, 46.4, 17.2, 49.0]
+    >>> classify_tiled(bbox, "2022-10-11/2022-10-25", "austria.zarr")
+    """
+    if zarr is None:
+        raise ImportError("Writing Zarr requires zarr, install dask_flood_mapper[zarr]")
+    flood.check_time_series_outputs(outputs)
+    tiling_config = config["tiling"]
+    if tiling_config["size"] % tiling_config["chunk"]:
+        raise ValueError("The tile size has to be a multiple of the chunk size")
+    items = search_items(SIG0_COLLECTION, bbox, datetime)
+    if len(items) == 0:
+        raise ValueError(f"No sigma naught data found within {bbox} at {datetime}")
+    geobox = source_geobox(items, bbox)
+    transform, shape = target_grid(
+        geobox.crs.wkt, geobox.transform, geobox.shape, bbox, TARGET_EPSG
+    )
+    grid = TiledGrid(transform, shape, item_times(items), tiling_config["chunk"])
+
+    run = {"bbox": list(bbox), "datetime": str(datetime), "outputs": list(outputs)}
+    done = completed_tiles(store, run)
+    created = done is not None
+    done = done or set()
+    lock = Lock()
+
+    def process(window):
+        nonlocal created
+        layers = classify_tile(grid, window, datetime, outputs)
+        if layers is None:
+            # tiles without data are searched again on resume until a store exists
+            if created:
+                record_tile(store, done, window, lock)
+            return
+        with lock:
+            if not created:
+                grid.create_store(store, layers, run)
+                created = True
+        grid.write(store, layers, window)
+        record_tile(store, done, window, lock)
+
+    windows = [
+        window
+        for window in grid.tiles(tiling_config["size"])
+        if tile_key(window) not in done
+    ]
+    executor = ThreadPoolExecutor(max_workers=tiling_config["workers"])
+    try:
+        for future in as_completed([executor.submit(process, w) for w in windows]):
+            future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+    zarr.consolidate_metadata(store)
+    return xr.open_zarr(store, decode_coords="all")
+
+
+def classify_tile(grid, window, datetime, outputs):
+    """Flood layers of one tile on its window of the grid, None without data."""
+    tile_transform, tile_shape = grid.window_grid(window)
+    west, south, east, north = array_bounds(*tile_shape, tile_transform)
+    halo = config["tiling"]["halo"]
+    bbox = [west - halo, south - halo, east + halo, north + halo]
+    items = search_items(SIG0_COLLECTION, bbox, datetime)
+    if len(items) == 0:
+        return None
+    sig0_dc, hpar_dc, plia_dc = flood.preprocess_items(items, bbox)
+    layers = flood.flood_layers(
+        sig0_dc, hpar_dc, plia_dc, bbox, outputs, grid=(tile_transform, tile_shape)
+    )
+    return layers.reset_coords(drop=True)
+
+
+class TiledGrid:
+    """Target grid of a tiled classification and the Zarr store holding it."""
+
+    def __init__(self, transform, shape, times, chunk):
+        self.transform = transform
+        self.shape = shape
+        self.times = times
+        self.chunk = chunk
+
+    def tiles(self, size):
+        """Windows of ``size`` pixels covering the grid, row by row."""
+        height, width = self.shape
+        return [
+            (slice(row, min(row + size, height)), slice(col, min(col + size, width)))
+            for row in range(0, height, size)
+            for col in range(0, width, size)
+        ]
+
+    def window_grid(self, window):
+        rows, cols = window
+        transform = self.transform * Affine.translation(cols.start, rows.start)
+        return transform, (rows.stop - rows.start, cols.stop - cols.start)
+
+    def create_store(self, store, layers, run):
+        """Write the coordinates and metadata of the store, without data.
+
+        The data types and attributes of the layers are taken from the first
+        tile. Regions that are never written read as no data.
+        """
+        height, width = self.shape
+        chunks = (1, self.chunk, self.chunk)
+        template = xr.Dataset(
+            {
+                name: (
+                    ("time", "y", "x"),
+                    da.full(
+                        (len(self.times), height, width),
+                        layer_nodata(layer),
+                        dtype=layer.dtype,
+                        chunks=chunks,
+                    ),
+                    layer.attrs,
+                )
+                for name, layer in layers.data_vars.items()
+            },
+            coords={
+                "time": self.times,
+                **affine_to_coords(self.transform, width, height),
+            },
+        )
+        template = template.rio.write_crs(TARGET_EPSG)
+        template = template.rio.write_transform(self.transform)
+        template = with_fill_value_encoding(template)
+        # unconsolidated, so that writes of regions never rewrite the group
+        # metadata holding the completed tiles
+        template.to_zarr(
+            store,
+            mode="w",
+            compute=False,
+            consolidated=False,
+            encoding=zarr_encoding(template),
+        )
+        group = zarr.open_group(store, mode="r+")
+        group.attrs["tiling"] = run
+        group.attrs["completed_tiles"] = []
+
+    def write(self, store, layers, window):
+        """Write the layers of one tile to its region of the store."""
+        layers = layers.reindex(
+            time=self.times,
+            fill_value={name: layer_nodata(layer) for name, layer in layers.items()},
+        )
+        layers = layers.chunk({"time": 1, "y": self.chunk, "x": self.chunk})
+        layers = layers.drop_vars(["time", "y", "x"]).drop_attrs()
+        rows, cols = window
+        layers.to_zarr(
+            store,
+            region={"time": slice(None), "y": rows, "x": cols},
+            consolidated=False,
+        )
+
+
+def completed_tiles(store, run):
+    """Tiles already written to ``store`` by the same run, None for a new store."""
+    try:
+        group = zarr.open_group(store, mode="r")
+    except FileNotFoundError:
+        return None
+    if group.attrs.get("tiling") != run:
+        raise ValueError(
+            f"{store} holds a different classification, remove it or use another store"
+        )
+    return set(group.attrs.get("completed_tiles", []))
+
+
+def record_tile(store, done, window, lock):
+    """Mark the tile at ``window`` as written in the attributes of ``store``."""
+    with lock:
+        done.add(tile_key(window))
+        zarr.open_group(store, mode="r+").attrs["completed_tiles"] = sorted(done)
+
+
+def source_geobox(items, bbox):
+    """Grid on which ``odc.stac.load`` loads the sigma naught items in ``bbox``."""
+    return odc_stac.output_geobox(
+        list(odc_stac.parse_items(items)), bands=["VV"], bbox=bbox
+    )
+
+
+def item_times(items):
+    """Sorted unique acquisition times of items, as on the loaded time axis."""
+    return np.unique(
+        [pd.Timestamp(item.datetime).tz_convert(None).to_datetime64() for item in items]
+    ).astype("datetime64[ns]")
+
+
+def layer_nodata(layer):
+    nodata = layer.rio.nodata
+    if nodata is None:
+        nodata = layer.attrs.get("_FillValue", np.nan)
+    return nodata
+
+
+def tile_key(window):
+    rows, cols = window
+    return f"{rows.start}_{cols.start}"
@@ -0,0 +1,152 @@
+import os
+from pathlib import Path
+
+import dask
+import numpy as np
+import pandas as pd
+import rasterio.shutil
+import rioxarray  # noqa
+import xarray as xr
+from dask.utils import SerializableLock
+
+from dask_flood_mapper.catalog import config
+
+try:
+    import zarr
+except ImportError:  # optional dependency, install with dask_flood_mapper[zarr]
+    zarr = None
+
+
+def to_zarr(layers, store, append=False, replace=False):
+    """Write flood layers to a Zarr store chunk by chunk.
+
+    Every Dask chunk is compressed and written by the worker that computed it,
+    so the layers never pass through the memory of the client. With
+    ``append`` an existing store is extended along time, skipping the time
+    steps it already holds, or with ``replace`` rewriting them in place. The
+    store has to be reachable from the workers.
+    """
+    if zarr is None:
+        raise ImportError("Writing Zarr requires zarr, install dask_flood_mapper[zarr]")
+    layers = with_fill_value_encoding(layers)
+    existing = existing_times(store) if append else None
+    if existing is None:
+        layers.to_zarr(store, mode="w", encoding=zarr_encoding(layers))
+        return
+    held = np.isin(layers.time.values, existing)
+    if replace:
+        for timestamp in layers.time.values[held]:
+            position = int(np.flatnonzero(existing == timestamp)[0])
+            rewritten = layers.sel(time=[timestamp])
+            rewritten = rewritten.drop_vars(
+                [
+                    name
+                    for name, var in rewritten.variables.items()
+                    if "time" not in var.dims
+                ]
+            )
+            rewritten.to_zarr(store, region={"time": slice(position, position + 1)})
+    layers = layers.isel(time=~held)
+    if layers.sizes["time"] > 0:
+        layers.to_zarr(store, append_dim="time")
+
+
+def existing_times(store):
+    """Time steps of a Zarr store, None if it does not exist yet."""
+    try:
+        with xr.open_zarr(store) as existing:
+            return existing.time.values
+    except FileNotFoundError:
+        return None
+
+
+def zarr_encoding(layers):
+    writer_config = config["writer"]
+    compressor = zarr.codecs.BloscCodec(
+        cname=writer_config["compression"],
+        clevel=writer_config["level"],
+        shuffle="bitshuffle",
+    )
+    return {
+        name: {**layer.encoding, "compressors": [compressor]}
+        for name, layer in layers.data_vars.items()
+    }
+
+
+def with_fill_value_encoding(layers):
+    """Move ``_FillValue`` attributes of encoded layers into their encoding."""
+    layers = layers.copy()
+    for name, layer in layers.data_vars.items():
+        if "_FillValue" in layer.attrs:
+            layer = layer.copy()
+            layer.encoding["_FillValue"] = layer.attrs.pop("_FillValue")
+            layers[name] = layer
+    return layers
+
+
+def to_cog(layers, directory, append=False):
+    """Write every layer and time step to a Cloud Optimized GeoTIFF.
+
+    The files are named ``{layer}_{time:%Y%m%dT%H%M%S}.tif``. The workers
+    write their chunks into tiled and compressed GeoTIFFs and convert every
+    finished GeoTIFF to a COG with internal overviews, which GDAL reads
+    block by block from disk, all in one computation. With ``append`` time
+    steps whose file exists are skipped. The directory has to be reachable
+    from the workers. Returns the paths of the written files.
+    """
+    writer_config = config["writer"]
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    options = {
+        "compress": writer_config["compression"],
+        "blockxsize": writer_config["blocksize"],
+        "blockysize": writer_config["blocksize"],
+    }
+
+    paths, conversions = [], []
+    for name, layer in layers.data_vars.items():
+        for timestamp in layer.time.values:
+            path = directory / f"{name}_{pd.Timestamp(timestamp):%Y%m%dT%H%M%S}.tif"
+            if append and path.exists():
+                continue
+            tiled = path.with_name(f".{path.stem}.tmp.tif")
+            write = layer.sel(time=timestamp).rio.to_raster(
+                tiled,
+                driver="GTiff",
+                tiled=True,
+                BIGTIFF="IF_SAFER",
+                lock=write_lock(tiled),
+                compute=False,
+                **options,
+            )
+            resampling = "MODE" if name == "decision" else "AVERAGE"
+            conversions.append(convert_to_cog(write, tiled, path, resampling, options))
+            paths.append(path)
+    dask.compute(*conversions)
+    return paths
+
+
+@dask.delayed
+def convert_to_cog(write, tiled, path, resampling, options):
+    """Copy the GeoTIFF at ``tiled`` into a COG at ``path`` once ``write`` is done."""
+    rasterio.shutil.copy(
+        tiled,
+        path,
+        driver="COG",
+        compress=options["compress"],
+        blocksize=options["blockxsize"],
+        overview_resampling=resampling,
+        BIGTIFF="IF_SAFER",
+    )
+    os.remove(tiled)
+
+
+def write_lock(path):
+    """Lock on the writes to one file, across processes on a cluster."""
+    try:
+        from distributed import Lock, default_client
+
+        default_client()  # the lock is held on its scheduler
+        return Lock(f"dask-flood-mapper-{path}")
+    except ValueError:  # no distributed client
+        return SerializableLock(str(path))